@@ -0,0 +1,408 @@
+''' Benchmarks of the data pipeline and the encoders.
+
+Example:
+    python -m benchmark --bench=memory --bmname=DD --max-nodes=500 --num_workers=4
+    python -m benchmark --bench=sparse --bmname=ENZYMES --max-nodes=100
+    python -m benchmark --bench=matmul --hidden-dim=64 --output-dim=64
+    python -m benchmark --bench=checkpoint --bmname=DD --max-nodes=500 --num-pool=2
+    python -m benchmark --bench=bf16 --bmname=ENZYMES --method=soft-assign --epochs=20
+    python -m benchmark --bench=compile --bmname=ENZYMES --method=soft-assign --epochs=3
+    python -m benchmark --bench=prefetch --bmname=DD --max-nodes=500 --num_workers=0 --epochs=3
+'''
+import numpy as np
+import torch
+
+import os
+import resource
+import time
+
+import cross_val
+import encoders
+import load_data
+import train
+from graph_sampler import add_dataset_features, build_loader, build_sampler
+
+
+# ---- process memory (Linux /proc)
+def _proc_kb(path, key):
+    try:
+        with open(path) as f:
+            for line in f:
+                if line.startswith(key + ':'):
+                    return int(line.split()[1])
+    except IOError:
+        pass
+    return 0
+
+def _children(pid):
+    children = []
+    task_dir = '/proc/%d/task' % pid
+    for tid in os.listdir(task_dir):
+        with open(os.path.join(task_dir, tid, 'children')) as f:
+            children += [int(child) for child in f.read().split()]
+    return children
+
+def reset_peak_rss():
+    ''' Reset the peak resident memory (VmHWM) of this process to its current one.
+    '''
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except IOError:
+        pass
+
+def process_tree_memory(pid=None):
+    ''' Resident (RSS) and proportional (PSS, counting shared pages once) memory in MB of a
+    process and all its descendants, e.g. the DataLoader workers.
+    '''
+    pids = [os.getpid() if pid is None else pid]
+    rss = pss = 0
+    while len(pids) > 0:
+        pid = pids.pop()
+        rss += _proc_kb('/proc/%d/status' % pid, 'VmRSS')
+        pss += _proc_kb('/proc/%d/smaps_rollup' % pid, 'Pss')
+        try:
+            pids += _children(pid)
+        except IOError:
+            pass
+    return rss / 1024.0, pss / 1024.0
+# ---------------------------
+
+
+def bench_memory(args):
+    ''' Peak memory of building the 10 cross validation folds and running one training epoch
+    of data loading per fold, with a dataset per fold (--noshare) or one shared dataset.
+    '''
+    graphs = read_graphs(args)
+
+    begin_time = time.time()
+    dataset = None
+    if args.share_dataset:
+        dataset = build_sampler(graphs, args, max_nodes=args.max_nodes, split='all')
+        dataset.share_memory()
+    peak_rss = peak_pss = 0
+    for i in range(10):
+        train_dataset, val_dataset, _, _, _ = cross_val.prepare_val_data(graphs, args, i,
+                max_nodes=args.max_nodes, dataset=dataset)
+        for data in train_dataset:
+            rss, pss = process_tree_memory()
+            peak_rss = max(peak_rss, rss)
+            peak_pss = max(peak_pss, pss)
+    print('shared dataset: ', args.share_dataset, '; workers: ', args.num_workers)
+    print('time: {0:.1f}s; peak RSS (sum over processes): {1:.0f} MB; peak PSS: {2:.0f} MB; '
+          'max RSS of main process: {3:.0f} MB'.format(time.time() - begin_time, peak_rss,
+                  peak_pss, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0))
+
+def bench_sparse(args, num_epochs=3):
+    ''' Training step time of GcnEncoderGraph with dense padded adjacency matrices, sparse
+    padded adjacency matrices (--sparse-adj) and packed block-diagonal graphs (--packed).
+    '''
+    graphs = read_graphs(args)
+    args.bucket = False
+    args.method = 'base'
+    for mode in ['dense', 'sparse', 'packed']:
+        args.sparse_adj = mode == 'sparse'
+        args.packed = mode == 'packed'
+        dataset_sampler = build_sampler(graphs, args, max_nodes=args.max_nodes)
+        dataset = build_loader(dataset_sampler, args, shuffle=True)
+        model = encoders.GcnEncoderGraph(dataset_sampler.feat_dim, args.hidden_dim,
+                args.output_dim, args.num_classes, args.num_gc_layers, bn=args.bn,
+                dropout=args.dropout, args=args).to(args.device)
+        optimizer = torch.optim.Adam(model.parameters(), lr=args.lr)
+        step_times = []
+        for epoch in range(num_epochs):
+            for data in dataset:
+                begin_time = time.time()
+                adj = data['adj'].float().to(args.device)
+                h0 = data['feats'].to(args.device)
+                label = data['label'].long().to(args.device)
+                batch = data['batch'].to(args.device) if 'batch' in data else None
+                model.zero_grad()
+                ypred = model(h0, adj, data['num_nodes'].int().numpy(), batch=batch)
+                loss = model.loss(ypred, label)
+                loss.backward()
+                optimizer.step()
+                if args.device.type == 'cuda':
+                    torch.cuda.synchronize()
+                # the first epoch is warm-up
+                if epoch > 0:
+                    step_times.append(time.time() - begin_time)
+        print('{0}: {1:.2f} ms per step'.format(mode, 1000 * np.mean(step_times)))
+
+def bench_matmul(args, num_iters=20):
+    ''' Forward and backward time of the graph convolutions of a DiffPool model on DD and
+    ENZYMES sized batches, with the products evaluated left to right ((adj @ x) @ W) and in the
+    order chosen by GraphConv.matmul_plan.
+    '''
+    # dataset: (max number of nodes, number of node features)
+    datasets = [('ENZYMES', 100, 21), ('DD', 500, 89)]
+    for name, max_nodes, feat_dim in datasets:
+        assign_dim = int(max_nodes * args.assign_ratio)
+        pred_input_dim = args.hidden_dim * (args.num_gc_layers - 1) + args.output_dim
+        # layer: (number of nodes, input_dim, output_dim)
+        layers = [('conv_first', max_nodes, feat_dim, args.hidden_dim),
+                  ('block', max_nodes, args.hidden_dim, args.hidden_dim),
+                  ('conv_last', max_nodes, args.hidden_dim, args.output_dim),
+                  ('assign conv_last', max_nodes, args.hidden_dim, assign_dim),
+                  ('pooled conv_first', assign_dim, pred_input_dim, args.hidden_dim)]
+        for layer, num_nodes, input_dim, output_dim in layers:
+            conv = encoders.GraphConv(input_dim, output_dim, add_self=True).to(args.device)
+            torch.nn.init.xavier_uniform_(conv.weight)
+            torch.nn.init.zeros_(conv.bias)
+            x = torch.rand(args.batch_size, num_nodes, input_dim, device=args.device)
+            # only the input features need no gradient
+            x.requires_grad_(layer != 'conv_first')
+            adj = (torch.rand(args.batch_size, num_nodes, num_nodes, device=args.device) <
+                    0.1).float()
+            times = {'adj_first': 0.0, 'weight_first': 0.0}
+            # alternate the orders, the first round is warm-up
+            for i in range(num_iters + 1):
+                for order in times:
+                    conv.matmul_order = order
+                    begin_time = time.time()
+                    conv(x, adj).sum().backward()
+                    if args.device.type == 'cuda':
+                        torch.cuda.synchronize()
+                    if i > 0:
+                        times[order] += (time.time() - begin_time) / num_iters
+            conv.matmul_order = None
+            plan = conv.matmul_plan(x, adj)
+            print('{0} {1} ({2}->{3}, {4} nodes): adj_first {5:.2f} ms, weight_first {6:.2f} ms; '
+                    'planned {7}'.format(name, layer, input_dim, output_dim, num_nodes,
+                    1000 * times['adj_first'], 1000 * times['weight_first'], plan['order']))
+
+def saved_tensor_bytes(fn):
+    ''' Run fn() and return its result and the number of bytes of the distinct tensors saved
+    for the backward pass while it runs (the activations kept alive until backward).
+    '''
+    saved = {}
+    def pack(tensor):
+        key = (tensor.untyped_storage().data_ptr(), tensor.storage_offset(), tensor.shape)
+        saved[key] = tensor.numel() * tensor.element_size()
+        return tensor
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor):
+        result = fn()
+    return result, sum(saved.values())
+
+def bench_checkpoint(args, num_batches=5):
+    ''' Activations kept for backward, training step time and peak memory of
+    SoftPoolingGcnEncoder without checkpointing and with --checkpoint=block and level. With
+    --checkpoint, only that mode runs (none for no checkpointing), so that the peak memory is
+    not affected by memory the allocator kept from other modes.
+    '''
+    graphs = read_graphs(args)
+    dataset_sampler = build_sampler(graphs, args, max_nodes=args.max_nodes)
+    dataset_sampler.num_buffers = 0
+    batches = []
+    for data in build_loader(dataset_sampler, args, shuffle=True):
+        batches.append(data)
+        if len(batches) == num_batches + 1:
+            break
+    modes = [None, 'block', 'level'] if args.checkpoint is None else [args.checkpoint]
+    for mode in modes:
+        args.checkpoint = mode
+        torch.manual_seed(0)
+        model = encoders.SoftPoolingGcnEncoder(dataset_sampler.max_num_nodes,
+                dataset_sampler.feat_dim, args.hidden_dim, args.output_dim, args.num_classes,
+                args.num_gc_layers, args.hidden_dim, assign_ratio=args.assign_ratio,
+                num_pooling=args.num_pool, bn=args.bn, dropout=args.dropout,
+                linkpred=args.linkpred, args=args,
+                assign_input_dim=dataset_sampler.assign_feat_dim).to(args.device)
+        step_times = []
+        saved_bytes = 0
+        # the first batch is warm-up
+        for i, data in enumerate(batches):
+            if i == 1:
+                if args.device.type == 'cuda':
+                    torch.cuda.reset_peak_memory_stats()
+                    base_memory = torch.cuda.memory_allocated() / 2.0 ** 20
+                else:
+                    reset_peak_rss()
+                    base_memory = _proc_kb('/proc/self/status', 'VmRSS') / 1024.0
+            begin_time = time.time()
+            adj = data['adj'].to(args.device)
+            batch_num_nodes = data['num_nodes'].int().numpy()
+            model.zero_grad()
+            loss, num_bytes = saved_tensor_bytes(lambda: model.loss(
+                    model(data['feats'].to(args.device), adj, batch_num_nodes,
+                          assign_x=data['assign_feats'].to(args.device)),
+                    data['label'].long().to(args.device), adj, batch_num_nodes))
+            loss.backward()
+            if args.device.type == 'cuda':
+                torch.cuda.synchronize()
+            if i > 0:
+                step_times.append(time.time() - begin_time)
+                saved_bytes = max(saved_bytes, num_bytes)
+        if args.device.type == 'cuda':
+            peak = torch.cuda.max_memory_allocated() / 2.0 ** 20
+        else:
+            peak = _proc_kb('/proc/self/status', 'VmHWM') / 1024.0
+        print('{0}: saved activations {1:.1f} MB, {2:.1f} ms per step, peak memory of the '
+                'steps {3:.0f} MB'.format(mode or 'none', saved_bytes / 2.0 ** 20,
+                1000 * np.mean(step_times), peak - base_memory))
+
+def read_graphs(args):
+    ''' Graphs of --bmname with their one-hot node labels as features, as read by
+    train.benchmark_task_val.
+    '''
+    data = train.read_benchmark(args)
+    graphs = load_data.to_networkx(data)
+    for G in graphs:
+        for u in G.nodes():
+            G.nodes[u]['feat'] = np.array(G.nodes[u]['label'])
+    add_dataset_features(graphs, data, args)
+    return graphs
+
+def build_model(args, max_num_nodes, input_dim, assign_input_dim):
+    ''' Model of --method, as built by train.benchmark_task_val.
+    '''
+    if args.method == 'soft-assign':
+        model = encoders.SoftPoolingGcnEncoder(max_num_nodes, input_dim, args.hidden_dim,
+                args.output_dim, args.num_classes, args.num_gc_layers, args.hidden_dim,
+                assign_ratio=args.assign_ratio, num_pooling=args.num_pool, bn=args.bn,
+                dropout=args.dropout, linkpred=args.linkpred, args=args,
+                assign_input_dim=assign_input_dim)
+    elif args.method == 'base-set2set':
+        model = encoders.GcnSet2SetEncoder(input_dim, args.hidden_dim, args.output_dim,
+                args.num_classes, args.num_gc_layers, bn=args.bn, dropout=args.dropout,
+                args=args)
+    else:
+        model = encoders.GcnEncoderGraph(input_dim, args.hidden_dim, args.output_dim,
+                args.num_classes, args.num_gc_layers, bn=args.bn, dropout=args.dropout,
+                args=args)
+    return model.to(args.device)
+
+def train_step(model, optimizer, data, args):
+    ''' One training step of train.train on a batch prepared by train.prepare_batch.
+
+    Returns:
+        the loss
+    '''
+    model.zero_grad()
+    with train.autocast(args):
+        ypred = model(data['feats'], data['adj'], data['num_nodes'],
+                assign_x=data['assign_feats'], batch=data.get('batch'))
+        if args.method == 'soft-assign' and args.linkpred:
+            loss = model.loss(ypred, data['label'], data['adj'], data['num_nodes'])
+        else:
+            loss = model.loss(ypred, data['label'])
+    loss.backward()
+    torch.nn.utils.clip_grad_norm_(model.parameters(), args.clip)
+    optimizer.step()
+    if args.device.type == 'cuda':
+        torch.cuda.synchronize()
+    return loss
+
+def bench_bf16(args):
+    ''' Training step time and validation accuracy (first fold of the 10-fold split) of the
+    model of --method trained for --epochs epochs in float32 and under bfloat16 autocast
+    (--bf16), from the same initialization and batches.
+    '''
+    graphs = read_graphs(args)
+    train_dataset, val_dataset, max_num_nodes, input_dim, assign_input_dim = \
+            cross_val.prepare_val_data(graphs, args, 0, max_nodes=args.max_nodes)
+    for bf16 in [False, True]:
+        args.bf16 = bf16
+        torch.manual_seed(0)
+        model = build_model(args, max_num_nodes, input_dim, assign_input_dim)
+        optimizer = torch.optim.Adam(model.parameters(), lr=args.lr)
+        step_times = []
+        for epoch in range(args.num_epochs):
+            model.train()
+            # same batches in both modes
+            torch.manual_seed(epoch)
+            for data in train_dataset:
+                data = train.prepare_batch(data, args)
+                begin_time = time.time()
+                loss = train_step(model, optimizer, data, args)
+                # the first epoch is warm-up
+                if epoch > 0 or args.num_epochs == 1:
+                    step_times.append(time.time() - begin_time)
+        result = train.evaluate(val_dataset, model, args, name='Validation')
+        print('{0}: {1:.2f} ms per step, validation accuracy {2:.4f}, last loss {3:.4f}'.format(
+                'bf16' if bf16 else 'fp32', 1000 * np.mean(step_times), result['acc'],
+                loss.item()))
+
+def bench_compile(args):
+    ''' Steady-state training step time of the model of --method in eager mode and compiled
+    (--compile), after a first epoch of warm-up (that includes the compilation, reported
+    separately).
+    '''
+    graphs = read_graphs(args)
+    dataset_sampler = build_sampler(graphs, args, max_nodes=args.max_nodes)
+    dataset = build_loader(dataset_sampler, args, shuffle=True)
+    for compile in [False, True]:
+        args.compile = compile
+        torch.manual_seed(0)
+        model = build_model(args, dataset_sampler.max_num_nodes, dataset_sampler.feat_dim,
+                dataset_sampler.assign_feat_dim)
+        train.compile_model(model, args)
+        optimizer = torch.optim.Adam(model.parameters(), lr=args.lr)
+        warmup_time = 0
+        step_times = []
+        for epoch in range(max(args.num_epochs, 2)):
+            for data in dataset:
+                data = train.prepare_batch(data, args)
+                begin_time = time.time()
+                train_step(model, optimizer, data, args)
+                # the first epoch is warm-up
+                if epoch > 0:
+                    step_times.append(time.time() - begin_time)
+                else:
+                    warmup_time += time.time() - begin_time
+        print('{0}: {1:.2f} ms per step, first epoch {2:.1f} s'.format(
+                'compiled' if compile else 'eager', 1000 * np.mean(step_times), warmup_time))
+
+def bench_prefetch(args):
+    ''' Epoch time and time the training loop waits for batches (input stall) of the model of
+    --method, with batches prepared in the training loop (--prefetch=0) and --prefetch batches
+    ahead by a background thread. The first epoch is warm-up.
+    '''
+    graphs = read_graphs(args)
+    dataset_sampler = build_sampler(graphs, args, max_nodes=args.max_nodes)
+    dataset = build_loader(dataset_sampler, args, shuffle=True)
+    for depth in [0, args.prefetch]:
+        args.prefetch = depth
+        torch.manual_seed(0)
+        model = build_model(args, dataset_sampler.max_num_nodes, dataset_sampler.feat_dim,
+                dataset_sampler.assign_feat_dim)
+        optimizer = torch.optim.Adam(model.parameters(), lr=args.lr)
+        epoch_times = []
+        stall_times = []
+        for epoch in range(max(args.num_epochs, 2)):
+            begin_time = time.time()
+            loader = train.prefetch(dataset, args)
+            for data in loader:
+                train_step(model, optimizer, data, args)
+            if epoch > 0:
+                epoch_times.append(time.time() - begin_time)
+                stall_times.append(loader.stall_time)
+        print('prefetch={0}: {1:.3f} s per epoch, input stall {2:.3f} s per epoch'.format(
+                depth, np.mean(epoch_times), np.mean(stall_times)))
+
+def main():
+    parser = train.build_arg_parser()
+    parser.add_argument('--bench', dest='bench',
+            help='Benchmark to run. Can be: memory, sparse, matmul, checkpoint, bf16, compile, '
+                 'prefetch')
+    parser.set_defaults(bench='memory')
+    args = parser.parse_args()
+    train.setup_device(args)
+
+    if args.bench == 'memory':
+        bench_memory(args)
+    elif args.bench == 'sparse':
+        bench_sparse(args)
+    elif args.bench == 'matmul':
+        bench_matmul(args)
+    elif args.bench == 'checkpoint':
+        bench_checkpoint(args)
+    elif args.bench == 'bf16':
+        bench_bf16(args)
+    elif args.bench == 'compile':
+        bench_compile(args)
+    elif args.bench == 'prefetch':
+        bench_prefetch(args)
+
+if __name__ == "__main__":
+    main()
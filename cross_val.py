@@ -5,18 +5,24 @@ import torch
 import pickle
 import random
 
-from graph_sampler import GraphSampler
-
-def prepare_val_data(graphs, args, val_idx, max_nodes=0):
-
-    random.shuffle(graphs)
-    val_size = len(graphs) // 10
-    train_graphs = graphs[:val_idx * val_size]
+from graph_sampler import build_loader, build_sampler
+
+def prepare_val_data(graphs, args, val_idx, max_nodes=0, dataset=None):
+    '''
+    Args:
+        dataset: GraphSampler built over graphs (in the order they had when it was built) and
+            shared by all folds. The folds then index into it instead of building new samplers.
+    '''
+    # with a shared dataset, the indices into it are shuffled instead of the graphs
+    items = graphs if dataset is None else list(range(len(graphs)))
+    random.shuffle(items)
+    val_size = len(items) // 10
+    train_items = items[:val_idx * val_size]
     if val_idx < 9:
-        train_graphs = train_graphs + graphs[(val_idx+1) * val_size :]
-    val_graphs = graphs[val_idx*val_size: (val_idx+1)*val_size]
-    print('Num training graphs: ', len(train_graphs), 
-          '; Num validation graphs: ', len(val_graphs))
+        train_items = train_items + items[(val_idx+1) * val_size :]
+    val_items = items[val_idx*val_size: (val_idx+1)*val_size]
+    print('Num training graphs: ', len(train_items), 
+          '; Num validation graphs: ', len(val_items))
 
     print('Number of graphs: ', len(graphs))
     print('Number of edges: ', sum([G.number_of_edges() for G in graphs]))
@@ -26,21 +32,23 @@ def prepare_val_data(graphs, args, val_idx, max_nodes=0):
             "{0:.2f}".format(np.std([G.number_of_nodes() for G in graphs])))
 
     # minibatch
-    dataset_sampler = GraphSampler(train_graphs, normalize=False, max_num_nodes=max_nodes,
-            features=args.feature_type)
-    train_dataset_loader = torch.utils.data.DataLoader(
-            dataset_sampler, 
-            batch_size=args.batch_size, 
-            shuffle=True,
-            num_workers=args.num_workers)
-
-    dataset_sampler = GraphSampler(val_graphs, normalize=False, max_num_nodes=max_nodes,
-            features=args.feature_type)
-    val_dataset_loader = torch.utils.data.DataLoader(
-            dataset_sampler, 
-            batch_size=args.batch_size, 
-            shuffle=False,
-            num_workers=args.num_workers)
+    if dataset is None:
+        dataset_sampler = build_sampler(train_items, args, max_nodes=max_nodes,
+                split='fold%d_train' % val_idx)
+        train_dataset = dataset_sampler
+    else:
+        dataset_sampler = dataset
+        train_dataset = torch.utils.data.Subset(dataset, train_items)
+    train_dataset_loader = build_loader(train_dataset, args, shuffle=True)
+
+    if dataset is None:
+        dataset_sampler = build_sampler(val_items, args, max_nodes=max_nodes,
+                split='fold%d_val' % val_idx)
+        val_dataset = dataset_sampler
+    else:
+        val_dataset = torch.utils.data.Subset(dataset, val_items)
+    val_dataset_loader = build_loader(val_dataset, args, shuffle=False,
+            batch_size=args.eval_batch_size)
 
     return train_dataset_loader, val_dataset_loader, \
             dataset_sampler.max_num_nodes, dataset_sampler.feat_dim, dataset_sampler.assign_feat_dim
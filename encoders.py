@@ -2,11 +2,75 @@ import torch
 import torch.nn as nn
 from torch.nn import init
 import torch.nn.functional as F
+import torch.utils.checkpoint
 
 import numpy as np
 
+import contextlib
+
 from set2set import Set2Set
 
+def adj_matmul(adj, x):
+    ''' adj @ x for a dense adj, or a sparse adj (batched COO, or 2D COO or CSR): the sparse
+    products cost O(num_edges * dim) instead of O(num_nodes^2 * dim).
+    '''
+    if adj.layout == torch.strided:
+        return torch.matmul(adj, x)
+    # sparse products have no bfloat16 kernels for batched COO or CSR: they run in the dtype
+    # of adj under autocast
+    with torch.autocast(device_type=adj.device.type, enabled=False):
+        x = x.to(adj.dtype)
+        if adj.dim() == 3:
+            return torch.bmm(adj, x)
+        return torch.sparse.mm(adj, x)
+
+def adj_matmul_cost(adj):
+    ''' Multiply-adds of adj @ x per column of x.
+    '''
+    if adj.layout == torch.strided:
+        return adj.numel()
+    if adj.layout == torch.sparse_coo:
+        return adj._nnz()
+    return adj.values().numel()
+
+def pool_adj(adj, assign):
+    ''' Pooled adjacency matrix S^T @ adj @ S of assignment matrix S.
+    '''
+    # both association orders cost the same for a dense adj, and a sparse adj can only be
+    # multiplied from the left, so the product is always evaluated as S^T @ (adj @ S)
+    return torch.transpose(assign, 1, 2) @ adj_matmul(adj, assign)
+
+@contextlib.contextmanager
+def frozen_bn_stats(module):
+    ''' Normalize with the batch statistics but leave the running statistics of the
+    MaskedBatchNorm layers of module unchanged, e.g. while a checkpointed forward is recomputed
+    in the backward pass (it already updated them once).
+    '''
+    layers = [m for m in module.modules() if isinstance(m, MaskedBatchNorm)]
+    for m in layers:
+        m.update_stats = False
+    try:
+        yield
+    finally:
+        for m in layers:
+            m.update_stats = True
+
+def segment_max(x, batch, num_segments):
+    ''' Max of the rows of x within each segment. Row i belongs to segment batch[i].
+    Returns:
+        [num_segments x dim] tensor
+    '''
+    index = batch.unsqueeze(1).expand_as(x)
+    return x.new_zeros(num_segments, x.size(1)).scatter_reduce(0, index, x, reduce='amax',
+            include_self=False)
+
+def segment_sum(x, batch, num_segments):
+    ''' Sum of the rows of x within each segment. Row i belongs to segment batch[i].
+    Returns:
+        [num_segments x dim] tensor
+    '''
+    return x.new_zeros(num_segments, x.size(1)).index_add_(0, batch, x)
+
 # GCN basic operation
 class GraphConv(nn.Module):
     def __init__(self, input_dim, output_dim, add_self=False, normalize_embedding=False,
@@ -19,26 +83,177 @@ class GraphConv(nn.Module):
         self.normalize_embedding = normalize_embedding
         self.input_dim = input_dim
         self.output_dim = output_dim
-        self.weight = nn.Parameter(torch.FloatTensor(input_dim, output_dim).cuda())
+        # association order of the products, None to choose it from the shapes (see matmul_plan)
+        self.matmul_order = None
+        # factor of adjacency multiply-adds that weight_first must save to be chosen
+        self.matmul_margin = 2.0
+        self.weight = nn.Parameter(torch.FloatTensor(input_dim, output_dim))
         if bias:
-            self.bias = nn.Parameter(torch.FloatTensor(output_dim).cuda())
+            self.bias = nn.Parameter(torch.FloatTensor(output_dim))
         else:
             self.bias = None
 
     def forward(self, x, adj):
+        ''' x is a [batch_size x num_nodes x input_dim] batch with a dense or sparse (COO)
+        [batch_size x num_nodes x num_nodes] adj, or the [num_nodes x input_dim] nodes of packed
+        graphs with a sparse (COO or CSR) block-diagonal adj.
+
+        Instead of one-hot rows, x can hold their label indices: an integer [... x 1] tensor of
+        1-based labels, 0 marking padding nodes (see GraphSampler features='label'). The
+        product with W is then a gather of rows of W, unless matmul_plan finds propagating the
+        one-hot rows cheaper.
+        '''
+        order = self.matmul_plan(x, adj)['order']
+        x = self.layer_input(x, order)
+        z = self.adj_input(x, order)
+        return self.adj_output(adj_matmul(adj, z), x, z, order)
+
+    def matmul_plan(self, x, adj):
+        ''' Association order of adj @ x @ W (plus x @ W with add_self), from the number of
+        multiply-adds of each order, forward and backward. The products with W cost the same in
+        both orders; the adjacency products differ:
+            adj_first: adj @ x, and adj^T @ grad for the gradient of x if x requires it
+            weight_first: adj @ (x @ W), and adj^T @ grad for the gradient of W
+        so weight_first pays off when output_dim is well below input_dim, but not on the
+        input features (which need no gradient) unless output_dim < input_dim / 2. Multiply-adds
+        do not account for the speed of each product, and measured times (benchmark.py
+        --bench=matmul) favour either order on small differences, so weight_first is only chosen
+        when its adjacency products cost at most 1 / matmul_margin of those of adj_first, and
+        save at least a fifth of the total (unlike on small pooled graphs, where the products
+        with W dominate).
+
+        Returns:
+            dict with 'order' ('adj_first': (adj @ x) @ W, or 'weight_first': adj @ (x @ W))
+            and 'cost' (multiply-adds of each order)
+        '''
+        backward = torch.is_grad_enabled() and self.weight.requires_grad
+        x_backward = backward and x.requires_grad
+        # label indices count as their one-hot rows
+        num_rows = x.numel() // x.size(-1)
+        adj_cost = adj_matmul_cost(adj)
+        weight_cost = num_rows * self.input_dim * self.output_dim * (1 + backward + x_backward)
+        adj_costs = {'adj_first': adj_cost * self.input_dim * (1 + x_backward),
+                     'weight_first': adj_cost * self.output_dim * (1 + backward)}
+        cost = {order: adj_costs[order] + weight_cost for order in adj_costs}
+        order = self.matmul_order
+        if order is None:
+            order = 'adj_first'
+            if adj_costs['weight_first'] * self.matmul_margin <= adj_costs['adj_first'] and \
+                    cost['weight_first'] <= 0.8 * cost['adj_first']:
+                order = 'weight_first'
+        return {'order': order, 'cost': cost}
+
+    def layer_input(self, x, order):
+        ''' The layer input after dropout. Label indices are expanded to one-hot rows for order
+        'adj_first'; otherwise their dropout is applied by adj_input.
+        '''
+        if not x.is_floating_point():
+            if order != 'adj_first':
+                return x
+            x = F.one_hot(x[..., 0].long(), self.input_dim + 1)[..., 1:].to(self.weight.dtype)
         if self.dropout > 0.001:
             x = self.dropout_layer(x)
-        y = torch.matmul(adj, x)
-        if self.add_self:
-            y += x
-        y = torch.matmul(y,self.weight)
+        return x
+
+    def adj_input(self, x, order):
+        ''' The matrix multiplied by adj: x, or x @ W for order 'weight_first'.
+        '''
+        if not x.is_floating_point():
+            # the rows of W of the labels, and zeros for padding nodes
+            z = F.embedding(x[..., 0].long(), F.pad(self.weight, (0, 0, 1, 0)))
+            if self.dropout > 0.001:
+                # dropout of a one-hot row keeps or zeros the whole row
+                z = z * self.dropout_layer(z.new_ones(z.shape[:-1] + (1,)))
+            return z
+        if order == 'weight_first':
+            return torch.matmul(x, self.weight)
+        return x
+
+    def adj_output(self, y, x, z, order):
+        ''' The layer output from y = adj @ z, z = adj_input(x, order) (x after dropout).
+        '''
+        if order == 'weight_first':
+            if self.add_self:
+                y = y + z
+        else:
+            if self.add_self:
+                y += x
+            y = torch.matmul(y,self.weight)
         if self.bias is not None:
             y = y + self.bias
         if self.normalize_embedding:
-            y = F.normalize(y, p=2, dim=2)
+            y = F.normalize(y, p=2, dim=-1)
             #print(y[0][0])
         return y
 
+class MaskedBatchNorm(nn.Module):
+    ''' Batch normalization of node embeddings over the feature dimension, with statistics over
+    the real nodes only: the rows of padded [batch_size x num_nodes x dim] embeddings selected
+    by a [batch_size x num_nodes x 1] mask, or all rows of [num_nodes x dim] packed embeddings.
+    Masked rows are zero in the output.
+    '''
+    def __init__(self, num_features, eps=1e-5, momentum=0.1):
+        super(MaskedBatchNorm, self).__init__()
+        self.num_features = num_features
+        self.eps = eps
+        self.momentum = momentum
+        self.weight = nn.Parameter(torch.ones(num_features))
+        self.bias = nn.Parameter(torch.zeros(num_features))
+        self.register_buffer('running_mean', torch.zeros(num_features))
+        self.register_buffer('running_var', torch.ones(num_features))
+        # update the running statistics in training mode, see frozen_bn_stats
+        self.update_stats = True
+
+    def forward(self, x, mask=None):
+        flat_x = x.reshape(-1, self.num_features)
+        if mask is None:
+            if self.training and flat_x.size(0) <= 1:
+                # F.batch_norm cannot normalize a single row in training mode
+                return self._masked_batch_norm(flat_x, flat_x.new_ones(flat_x.size(0), 1)
+                        ).view_as(x)
+            return self._batch_norm(flat_x).view_as(x)
+        if torch.compiler.is_compiling():
+            return self._masked_batch_norm(flat_x, mask.reshape(-1, 1)).view_as(x)
+        # normalize the real rows only (fused kernel), and leave the masked ones zero
+        real = mask.reshape(-1) > 0
+        if self.training and int(real.sum()) <= 1:
+            return self._masked_batch_norm(flat_x, mask.reshape(-1, 1)).view_as(x)
+        y = flat_x.new_zeros(flat_x.shape)
+        y[real] = self._batch_norm(flat_x[real])
+        return y.view_as(x)
+
+    def _batch_norm(self, x):
+        running_mean, running_var = self.running_mean, self.running_var
+        if self.training and not self.update_stats:
+            # updates of copies, to save the same tensors for backward as with updates
+            running_mean, running_var = running_mean.clone(), running_var.clone()
+        return F.batch_norm(x, running_mean, running_var, self.weight, self.bias,
+                self.training, self.momentum, self.eps)
+
+    def _masked_batch_norm(self, x, mask):
+        ''' Same as normalizing the rows x[mask > 0] with _batch_norm, from sums over all rows
+        weighted by mask: unlike the indexing by mask, the shapes do not depend on the values of
+        mask, so torch.compile captures it in one graph for all batches. With a single real row,
+        which has no unbiased variance, the running statistics are left as they are.
+        '''
+        dtype = x.dtype
+        x, mask = x.float(), mask.float()
+        if self.training:
+            count = torch.sum(mask)
+            mean = torch.sum(x * mask, dim=0) / count
+            var = torch.sum(((x - mean) * mask) ** 2, dim=0) / count
+            if self.update_stats:
+                with torch.no_grad():
+                    momentum = self.momentum * (count > 1).float()
+                    self.running_mean.mul_(1 - momentum).add_(momentum * mean)
+                    # unbiased variance, as F.batch_norm
+                    self.running_var.mul_(1 - momentum).add_(
+                            momentum * var * count / torch.clamp(count - 1, min=1))
+        else:
+            mean, var = self.running_mean, self.running_var
+        y = (x - mean) * torch.rsqrt(var + self.eps) * self.weight + self.bias
+        return (y * mask).to(dtype)
+
 class GcnEncoderGraph(nn.Module):
     def __init__(self, input_dim, hidden_dim, embedding_dim, label_dim, num_layers,
             pred_hidden_dims=[], concat=True, bn=True, dropout=0.0, args=None):
@@ -52,10 +267,16 @@ class GcnEncoderGraph(nn.Module):
         self.bias = True
         if args is not None:
             self.bias = args.bias
+        # activation checkpointing: None, 'block' (each conv layer) or 'level' (each stack of
+        # conv layers), see checkpointed
+        self.checkpoint = None
+        if args is not None:
+            self.checkpoint = args.checkpoint
 
         self.conv_first, self.conv_block, self.conv_last = self.build_conv_layers(
                 input_dim, hidden_dim, embedding_dim, num_layers, 
                 add_self, normalize=True, dropout=dropout)
+        self.bn_layers = self.build_bn_layers(hidden_dim, num_layers)
         self.act = nn.ReLU()
         self.label_dim = label_dim
 
@@ -84,6 +305,12 @@ class GcnEncoderGraph(nn.Module):
                 normalize_embedding=normalize, bias=self.bias)
         return conv_first, conv_block, conv_last
 
+    def build_bn_layers(self, hidden_dim, num_layers):
+        ''' Batch normalization after conv_first and each layer of conv_block (see
+        build_conv_layers).
+        '''
+        return nn.ModuleList([MaskedBatchNorm(hidden_dim) for i in range(num_layers-1)])
+
     def build_pred_layers(self, pred_input_dim, pred_hidden_dims, label_dim, num_aggs=1):
         pred_input_dim = pred_input_dim * num_aggs
         if len(pred_hidden_dims) == 0:
@@ -103,97 +330,199 @@ class GcnEncoderGraph(nn.Module):
         corresponding column are 1's, and the rest are 0's (to be masked out).
         Dimension of mask: [batch_size x max_nodes x 1]
         '''
-        # masks
-        packed_masks = [torch.ones(int(num)) for num in batch_num_nodes]
-        batch_size = len(batch_num_nodes)
-        out_tensor = torch.zeros(batch_size, max_nodes)
-        for i, mask in enumerate(packed_masks):
-            out_tensor[i, :batch_num_nodes[i]] = mask
-        return out_tensor.unsqueeze(2).cuda()
-
-    def apply_bn(self, x):
-        ''' Batch normalization of 3D tensor x
+        # masks, on the device of the model
+        device = self.conv_first.weight.device
+        num_nodes = torch.as_tensor(np.asarray(batch_num_nodes), device=device)
+        out_tensor = torch.arange(max_nodes, device=device) < num_nodes.unsqueeze(1)
+        return out_tensor.unsqueeze(2).float()
+
+    def checkpointed(self, granularity, fn, *inputs):
+        ''' fn(*inputs), with activation checkpointing if self.checkpoint is granularity: the
+        intermediate activations of fn are not kept for the backward pass but recomputed in it.
+        The recomputation does not update the batch normalization statistics again.
+        '''
+        if self.checkpoint != granularity or not torch.is_grad_enabled():
+            return fn(*inputs)
+        return torch.utils.checkpoint.checkpoint(fn, *inputs, use_reentrant=False,
+                context_fn=lambda: (contextlib.nullcontext(), frozen_bn_stats(self)))
+
+    def conv_layer(self, conv, x, adj, bn_layer=None, embedding_mask=None, act=True):
+        ''' A conv layer, followed by the activation (if act) and batch normalization (if
+        self.bn and bn_layer is given). The unit of 'block' checkpointing.
         '''
-        bn_module = nn.BatchNorm1d(x.size()[1]).cuda()
-        return bn_module(x)
+        x = conv(x, adj)
+        if act:
+            x = self.act(x)
+        if self.bn and bn_layer is not None:
+            x = bn_layer(x, embedding_mask)
+        return x
 
-    def gcn_forward(self, x, adj, conv_first, conv_block, conv_last, embedding_mask=None):
+    def gcn_forward(self, x, adj, conv_first, conv_block, conv_last, embedding_mask=None,
+            bn_layers=None):
 
         ''' Perform forward prop with graph convolution.
+        bn_layers: batch normalization layers of the conv layers (see build_bn_layers), used
+            if self.bn.
         Returns:
-            Embedding matrix with dimension [batch_size x num_nodes x embedding]
+            Embedding matrix with dimension [batch_size x num_nodes x embedding], or
+            [num_nodes x embedding] for packed graphs
         '''
+        if bn_layers is None:
+            bn_layers = [None] * (len(conv_block) + 1)
 
-        x = conv_first(x, adj)
-        x = self.act(x)
-        if self.bn:
-            x = self.apply_bn(x)
+        x = self.checkpointed('block', self.conv_layer, conv_first, x, adj, bn_layers[0],
+                embedding_mask)
         x_all = [x]
         #out_all = []
         #out, _ = torch.max(x, dim=1)
         #out_all.append(out)
         for i in range(len(conv_block)):
-            x = conv_block[i](x,adj)
-            x = self.act(x)
-            if self.bn:
-                x = self.apply_bn(x)
+            x = self.checkpointed('block', self.conv_layer, conv_block[i], x, adj,
+                    bn_layers[i+1], embedding_mask)
             x_all.append(x)
-        x = conv_last(x,adj)
+        x = self.checkpointed('block', self.conv_layer, conv_last, x, adj, None, None, False)
         x_all.append(x)
         # x_tensor: [batch_size x num_nodes x embedding]
-        x_tensor = torch.cat(x_all, dim=2)
+        x_tensor = torch.cat(x_all, dim=-1)
         if embedding_mask is not None:
             x_tensor = x_tensor * embedding_mask
         return x_tensor
 
-    def forward(self, x, adj, batch_num_nodes=None, **kwargs):
+    def readout(self, x, batch=None, num_graphs=None, aggr='max', mask=None):
+        ''' Max or sum over the nodes of each graph, of a padded batch or, given batch (the
+        graph index of each node), of packed graphs. Given mask, the padding nodes of a padded
+        batch are left out, as in the packed readouts, so that the readout does not depend on the
+        padding.
+        '''
+        if batch is None:
+            if aggr == 'max':
+                if mask is not None:
+                    x = x.masked_fill(mask == 0, float('-inf'))
+                out, _ = torch.max(x, dim=1)
+                return out
+            if mask is not None:
+                x = x * mask
+            return torch.sum(x, dim=1)
+        if aggr == 'max':
+            return segment_max(x, batch, num_graphs)
+        return segment_sum(x, batch, num_graphs)
+
+    def fused_conv(self, convs, xs, adj):
+        ''' Apply the GraphConv layers convs to their inputs xs over the same adj, with a single
+        adjacency product of the concatenated inputs.
+        '''
+        orders = [conv.matmul_plan(x, adj)['order'] for conv, x in zip(convs, xs)]
+        xs = [conv.layer_input(x, order) for conv, x, order in zip(convs, xs, orders)]
+        zs = [conv.adj_input(x, order) for conv, x, order in zip(convs, xs, orders)]
+        ys = torch.split(adj_matmul(adj, torch.cat(zs, dim=-1)), [z.size(-1) for z in zs],
+                dim=-1)
+        return [conv.adj_output(y, x, z, order) for conv, x, y, z, order in
+                zip(convs, xs, ys, zs, orders)]
+
+    def fused_layer(self, convs, xs, adj, bn_layers=None, embedding_mask=None, act=True):
+        ''' conv_layer of several stacks, with fused_conv.
+        '''
+        xs = self.fused_conv(convs, xs, adj)
+        if act:
+            xs = [self.act(x) for x in xs]
+        if self.bn and bn_layers is not None:
+            xs = [bn_layer(x, embedding_mask) for bn_layer, x in zip(bn_layers, xs)]
+        return xs
+
+    def gcn_forward_fused(self, xs, adj, stacks, embedding_mask=None):
+        ''' gcn_forward of several stacks of conv layers with the same number of layers over the
+        same adj. The stacks share the adjacency products: at each layer, their inputs are
+        concatenated and multiplied by adj once (see fused_conv).
+
+        Args:
+            xs: input of each stack.
+            stacks: (conv_first, conv_block, conv_last, bn_layers) of each stack.
+        Returns:
+            Embedding matrix of each stack
+        '''
+        xs = self.checkpointed('block', self.fused_layer, [stack[0] for stack in stacks], xs,
+                adj, [stack[3][0] for stack in stacks], embedding_mask)
+        x_alls = [[x] for x in xs]
+        for i in range(len(stacks[0][1])):
+            xs = self.checkpointed('block', self.fused_layer, [stack[1][i] for stack in stacks],
+                    xs, adj, [stack[3][i+1] for stack in stacks], embedding_mask)
+            for x_all, x in zip(x_alls, xs):
+                x_all.append(x)
+        xs = self.checkpointed('block', self.fused_layer, [stack[2] for stack in stacks], xs,
+                adj, None, None, False)
+        x_tensors = []
+        for x_all, x in zip(x_alls, xs):
+            x_all.append(x)
+            x_tensor = torch.cat(x_all, dim=-1)
+            if embedding_mask is not None:
+                x_tensor = x_tensor * embedding_mask
+            x_tensors.append(x_tensor)
+        return x_tensors
+
+    def forward(self, x, adj, batch_num_nodes=None, batch=None, **kwargs):
+        ''' With batch (graph index of each node), x and adj are packed graphs, see
+        GraphSampler.collate_packed.
+        '''
         # mask
-        max_num_nodes = adj.size()[1]
-        if batch_num_nodes is not None:
+        num_graphs = None
+        if batch is not None:
+            num_graphs = len(batch_num_nodes) if batch_num_nodes is not None else \
+                    int(batch[-1]) + 1
+            self.embedding_mask = None
+        elif batch_num_nodes is not None:
+            max_num_nodes = adj.size()[1]
             self.embedding_mask = self.construct_mask(max_num_nodes, batch_num_nodes)
         else:
             self.embedding_mask = None
 
         # conv
-        x = self.conv_first(x, adj)
-        x = self.act(x)
-        if self.bn:
-            x = self.apply_bn(x)
+        out_all = self.checkpointed('level', self.conv_readouts, x, adj, batch, num_graphs)
+        out = out_all[-1]
+        if self.concat:
+            output = torch.cat(out_all, dim=1)
+        else:
+            output = out
+        ypred = self.pred_model(output)
+        #print(output.size())
+        return ypred
+
+    def conv_readouts(self, x, adj, batch=None, num_graphs=None):
+        ''' Readouts of the outputs of the conv layers, as concatenated by forward.
+        '''
+        x = self.checkpointed('block', self.conv_layer, self.conv_first, x, adj,
+                self.bn_layers[0], self.embedding_mask)
         out_all = []
-        out, _ = torch.max(x, dim=1)
+        out = self.readout(x, batch, num_graphs, mask=self.embedding_mask)
         out_all.append(out)
         for i in range(self.num_layers-2):
-            x = self.conv_block[i](x,adj)
-            x = self.act(x)
-            if self.bn:
-                x = self.apply_bn(x)
-            out,_ = torch.max(x, dim=1)
+            x = self.checkpointed('block', self.conv_layer, self.conv_block[i], x, adj,
+                    self.bn_layers[i+1], self.embedding_mask)
+            out = self.readout(x, batch, num_graphs, mask=self.embedding_mask)
             out_all.append(out)
             if self.num_aggs == 2:
-                out = torch.sum(x, dim=1)
+                out = self.readout(x, batch, num_graphs, aggr='sum',
+                        mask=self.embedding_mask)
                 out_all.append(out)
-        x = self.conv_last(x,adj)
+        x = self.checkpointed('block', self.conv_layer, self.conv_last, x, adj, None, None,
+                False)
         #x = self.act(x)
-        out, _ = torch.max(x, dim=1)
+        out = self.readout(x, batch, num_graphs, mask=self.embedding_mask)
         out_all.append(out)
         if self.num_aggs == 2:
-            out = torch.sum(x, dim=1)
+            out = self.readout(x, batch, num_graphs, aggr='sum',
+                    mask=self.embedding_mask)
             out_all.append(out)
-        if self.concat:
-            output = torch.cat(out_all, dim=1)
-        else:
-            output = out
-        ypred = self.pred_model(output)
-        #print(output.size())
-        return ypred
+        return out_all
 
     def loss(self, pred, label, type='softmax'):
         # softmax + CE
         if type == 'softmax':
-            return F.cross_entropy(pred, label, reduction='mean')
+            # in float32 under bf16 autocast
+            return F.cross_entropy(pred.float(), label, reduction='mean')
         elif type == 'margin':
             batch_size = pred.size()[0]
-            label_onehot = torch.zeros(batch_size, self.label_dim).long().cuda()
+            label_onehot = torch.zeros(batch_size, self.label_dim, dtype=torch.long,
+                    device=pred.device)
             label_onehot.scatter_(1, label.view(-1,1), 1)
             return torch.nn.MultiLabelMarginLoss()(pred, label_onehot)
             
@@ -202,22 +531,39 @@ class GcnEncoderGraph(nn.Module):
 
 class GcnSet2SetEncoder(GcnEncoderGraph):
     def __init__(self, input_dim, hidden_dim, embedding_dim, label_dim, num_layers,
-            pred_hidden_dims=[], concat=True, bn=True, dropout=0.0, args=None):
+            pred_hidden_dims=[], concat=True, bn=True, dropout=0.0, processing_steps=None,
+            args=None):
+        '''
+        Args:
+            processing_steps: number of Set2Set attention steps (None: one per node slot).
+                Overridden by args.s2s_steps (0 for one per node slot).
+        '''
         super(GcnSet2SetEncoder, self).__init__(input_dim, hidden_dim, embedding_dim, label_dim,
                 num_layers, pred_hidden_dims, concat, bn, dropout, args=args)
-        self.s2s = Set2Set(self.pred_input_dim, self.pred_input_dim * 2)
+        if args is not None:
+            processing_steps = args.s2s_steps if args.s2s_steps > 0 else None
+        self.s2s = Set2Set(self.pred_input_dim, self.pred_input_dim * 2,
+                processing_steps=processing_steps)
 
-    def forward(self, x, adj, batch_num_nodes=None, **kwargs):
+    def forward(self, x, adj, batch_num_nodes=None, batch=None, **kwargs):
+        ''' With batch (graph index of each node), x and adj are packed graphs, see
+        GraphSampler.collate_packed.
+        '''
         # mask
-        max_num_nodes = adj.size()[1]
-        if batch_num_nodes is not None:
+        num_graphs = None
+        if batch is not None:
+            num_graphs = len(batch_num_nodes) if batch_num_nodes is not None else \
+                    int(batch[-1]) + 1
+            embedding_mask = None
+        elif batch_num_nodes is not None:
+            max_num_nodes = adj.size()[1]
             embedding_mask = self.construct_mask(max_num_nodes, batch_num_nodes)
         else:
             embedding_mask = None
 
-        embedding_tensor = self.gcn_forward(x, adj,
-                self.conv_first, self.conv_block, self.conv_last, embedding_mask)
-        out = self.s2s(embedding_tensor)
+        embedding_tensor = self.checkpointed('level', self.gcn_forward, x, adj,
+                self.conv_first, self.conv_block, self.conv_last, embedding_mask, self.bn_layers)
+        out = self.s2s(embedding_tensor, mask=embedding_mask, batch=batch, num_graphs=num_graphs)
         #out, _ = torch.max(embedding_tensor, dim=1)
         ypred = self.pred_model(out)
         return ypred
@@ -241,11 +587,24 @@ class SoftPoolingGcnEncoder(GcnEncoderGraph):
         self.num_pooling = num_pooling
         self.linkpred = linkpred
         self.assign_ent = True
+        # link prediction loss: 'dense', 'chunked' or 'sampled', see loss
+        self.linkpred_mode = 'dense'
+        self.linkpred_chunk = 128
+        self.linkpred_neg_ratio = 1.0
+        if args is not None:
+            self.linkpred_mode = args.linkpred_mode
+            self.linkpred_chunk = args.linkpred_chunk
+            self.linkpred_neg_ratio = args.linkpred_neg_ratio
+        # share the adjacency products of the embedding and assignment stacks of each level
+        self.fuse_assign = False
+        if args is not None:
+            self.fuse_assign = args.fuse_assign
 
         # GC
         self.conv_first_after_pool = nn.ModuleList()
         self.conv_block_after_pool = nn.ModuleList()
         self.conv_last_after_pool = nn.ModuleList()
+        self.bn_after_pool = nn.ModuleList()
         for i in range(num_pooling):
             # use self to register the modules in self.modules()
             conv_first2, conv_block2, conv_last2 = self.build_conv_layers(
@@ -254,6 +613,7 @@ class SoftPoolingGcnEncoder(GcnEncoderGraph):
             self.conv_first_after_pool.append(conv_first2)
             self.conv_block_after_pool.append(conv_block2)
             self.conv_last_after_pool.append(conv_last2)
+            self.bn_after_pool.append(self.build_bn_layers(hidden_dim, num_layers))
 
         # assignment
         assign_dims = []
@@ -264,6 +624,7 @@ class SoftPoolingGcnEncoder(GcnEncoderGraph):
 
         self.assign_conv_first_modules = nn.ModuleList()
         self.assign_conv_block_modules = nn.ModuleList()
+        self.assign_bn_modules = nn.ModuleList()
         self.assign_conv_last_modules = nn.ModuleList()
         self.assign_pred_modules = nn.ModuleList()
         assign_dim = int(max_num_nodes * assign_ratio)
@@ -284,6 +645,7 @@ class SoftPoolingGcnEncoder(GcnEncoderGraph):
             self.assign_conv_block_modules.append(assign_conv_block)
             self.assign_conv_last_modules.append(assign_conv_last)
             self.assign_pred_modules.append(assign_pred)
+            self.assign_bn_modules.append(self.build_bn_layers(assign_hidden_dim, assign_num_layers))
 
         self.pred_model = self.build_pred_layers(self.pred_input_dim * (num_pooling+1), pred_hidden_dims, 
                 label_dim, num_aggs=self.num_aggs)
@@ -317,13 +679,26 @@ class SoftPoolingGcnEncoder(GcnEncoderGraph):
         #if embedding_mask is not None:
         #    self.assign_tensor = self.assign_tensor * embedding_mask
         # [batch_size x num_nodes x embedding_dim]
-        embedding_tensor = self.gcn_forward(x, adj,
-                self.conv_first, self.conv_block, self.conv_last, embedding_mask)
+        # with fuse_assign, the assignment stack of each level runs with the embedding stack
+        # over the same adj (a level's assignment input x_a is its embedding input x, except
+        # for the assignment features of the first level)
+        fuse_assign = self.fuse_assign and all(len(self.assign_conv_block_modules[i]) ==
+                len(self.conv_block) for i in range(self.num_pooling))
+        assign_embedding = None
+        if fuse_assign:
+            embedding_tensor, assign_embedding = self.checkpointed('level',
+                    self.gcn_forward_fused, [x, x_a], adj,
+                    [(self.conv_first, self.conv_block, self.conv_last, self.bn_layers),
+                     self.assign_stack(0)], embedding_mask)
+        else:
+            embedding_tensor = self.checkpointed('level', self.gcn_forward, x, adj,
+                    self.conv_first, self.conv_block, self.conv_last, embedding_mask,
+                    self.bn_layers)
 
-        out, _ = torch.max(embedding_tensor, dim=1)
+        out = self.readout(embedding_tensor, mask=embedding_mask)
         out_all.append(out)
         if self.num_aggs == 2:
-            out = torch.sum(embedding_tensor, dim=1)
+            out = self.readout(embedding_tensor, aggr='sum', mask=embedding_mask)
             out_all.append(out)
 
         for i in range(self.num_pooling):
@@ -332,22 +707,33 @@ class SoftPoolingGcnEncoder(GcnEncoderGraph):
             else:
                 embedding_mask = None
 
-            self.assign_tensor = self.gcn_forward(x_a, adj, 
-                    self.assign_conv_first_modules[i], self.assign_conv_block_modules[i], self.assign_conv_last_modules[i],
-                    embedding_mask)
-            # [batch_size x num_nodes x next_lvl_num_nodes]
-            self.assign_tensor = nn.Softmax(dim=-1)(self.assign_pred_modules[i](self.assign_tensor))
+            if assign_embedding is None:
+                assign_embedding = self.checkpointed('level', self.gcn_forward, x_a, adj,
+                        self.assign_conv_first_modules[i], self.assign_conv_block_modules[i], self.assign_conv_last_modules[i],
+                        embedding_mask, self.assign_bn_modules[i])
+            self.assign_tensor = assign_embedding
+            assign_embedding = None
+            # [batch_size x num_nodes x next_lvl_num_nodes], softmax in float32 under bf16
+            # autocast
+            self.assign_tensor = nn.Softmax(dim=-1)(
+                    self.assign_pred_modules[i](self.assign_tensor).float())
             if embedding_mask is not None:
                 self.assign_tensor = self.assign_tensor * embedding_mask
 
             # update pooled features and adj matrix
             x = torch.matmul(torch.transpose(self.assign_tensor, 1, 2), embedding_tensor)
-            adj = torch.transpose(self.assign_tensor, 1, 2) @ adj @ self.assign_tensor
+            adj = pool_adj(adj, self.assign_tensor)
             x_a = x
         
-            embedding_tensor = self.gcn_forward(x, adj, 
-                    self.conv_first_after_pool[i], self.conv_block_after_pool[i],
-                    self.conv_last_after_pool[i])
+            after_pool_stack = (self.conv_first_after_pool[i], self.conv_block_after_pool[i],
+                    self.conv_last_after_pool[i], self.bn_after_pool[i])
+            if fuse_assign and i + 1 < self.num_pooling:
+                embedding_tensor, assign_embedding = self.checkpointed('level',
+                        self.gcn_forward_fused, [x, x_a], adj,
+                        [after_pool_stack, self.assign_stack(i + 1)])
+            else:
+                embedding_tensor = self.checkpointed('level', self.gcn_forward, x, adj,
+                        *after_pool_stack[:3], None, after_pool_stack[3])
 
 
             out, _ = torch.max(embedding_tensor, dim=1)
@@ -365,37 +751,161 @@ class SoftPoolingGcnEncoder(GcnEncoderGraph):
         ypred = self.pred_model(output)
         return ypred
 
+    def assign_stack(self, i):
+        ''' (conv_first, conv_block, conv_last, bn_layers) of the assignment stack of level i.
+        '''
+        return (self.assign_conv_first_modules[i], self.assign_conv_block_modules[i],
+                self.assign_conv_last_modules[i], self.assign_bn_modules[i])
+
     def loss(self, pred, label, adj=None, batch_num_nodes=None, adj_hop=1):
         ''' 
         Args:
             batch_num_nodes: numpy array of number of nodes in each graph in the minibatch.
         '''
-        eps = 1e-7
         loss = super(SoftPoolingGcnEncoder, self).loss(pred, label)
         if self.linkpred:
-            max_num_nodes = adj.size()[1]
-            pred_adj0 = self.assign_tensor @ torch.transpose(self.assign_tensor, 1, 2) 
-            tmp = pred_adj0
-            pred_adj = pred_adj0
-            for adj_pow in range(adj_hop-1):
-                tmp = tmp @ pred_adj0
-                pred_adj = pred_adj + tmp
-            pred_adj = torch.min(pred_adj, torch.ones(1, dtype=pred_adj.dtype).cuda())
-            #print('adj1', torch.sum(pred_adj0) / torch.numel(pred_adj0))
-            #print('adj2', torch.sum(pred_adj) / torch.numel(pred_adj))
-            #self.link_loss = F.nll_loss(torch.log(pred_adj), adj)
-            self.link_loss = -adj * torch.log(pred_adj+eps) - (1-adj) * torch.log(1-pred_adj+eps)
             if batch_num_nodes is None:
-                num_entries = max_num_nodes * max_num_nodes * adj.size()[0]
                 print('Warning: calculating link pred loss without masking')
+            if self.linkpred_mode == 'dense':
+                self.link_loss = self.dense_link_loss(adj, batch_num_nodes, adj_hop)
+            elif self.linkpred_mode == 'chunked':
+                self.link_loss = self.chunked_link_loss(adj, batch_num_nodes, adj_hop)
             else:
-                num_entries = np.sum(batch_num_nodes * batch_num_nodes)
-                embedding_mask = self.construct_mask(max_num_nodes, batch_num_nodes)
-                adj_mask = embedding_mask @ torch.transpose(embedding_mask, 1, 2)
-                self.link_loss[(1-adj_mask).bool()] = 0.0
-
-            self.link_loss = torch.sum(self.link_loss) / float(num_entries)
+                self.link_loss = self.sampled_link_loss(adj, batch_num_nodes, adj_hop)
             #print('linkloss: ', self.link_loss)
             return loss + self.link_loss
         return loss
 
+    def link_pred_factors(self, adj_hop=1):
+        ''' The predicted adjacency sum_{j=1..adj_hop} (S S^T)^j (before clamping to 1) of
+        the assignment matrix S, factored as (S M) S^T with the [batch_size x k x k] matrix
+        M = sum_{j<adj_hop} (S^T S)^j.
+        Returns:
+            S M, S
+        '''
+        assign = self.assign_tensor
+        gram = torch.transpose(assign, 1, 2) @ assign
+        power = torch.eye(gram.size(1), dtype=gram.dtype, device=gram.device).expand_as(gram)
+        hops = power
+        for adj_pow in range(adj_hop-1):
+            power = power @ gram
+            hops = hops + power
+        return assign @ hops, assign
+
+    def dense_link_loss(self, adj, batch_num_nodes, adj_hop=1):
+        ''' Link prediction loss over the full predicted adjacency matrix. Memory grows with
+        batch_size * max_num_nodes^2.
+        '''
+        eps = 1e-7
+        if adj.layout != torch.strided:
+            adj = adj.to_dense()
+        max_num_nodes = adj.size()[1]
+        pred_adj0 = self.assign_tensor @ torch.transpose(self.assign_tensor, 1, 2) 
+        tmp = pred_adj0
+        pred_adj = pred_adj0
+        for adj_pow in range(adj_hop-1):
+            tmp = tmp @ pred_adj0
+            pred_adj = pred_adj + tmp
+        pred_adj = torch.min(pred_adj.float(), torch.ones(1, dtype=torch.float32,
+                device=pred_adj.device))
+        #print('adj1', torch.sum(pred_adj0) / torch.numel(pred_adj0))
+        #print('adj2', torch.sum(pred_adj) / torch.numel(pred_adj))
+        #self.link_loss = F.nll_loss(torch.log(pred_adj), adj)
+        link_loss = -adj * torch.log(pred_adj+eps) - (1-adj) * torch.log(1-pred_adj+eps)
+        if batch_num_nodes is None:
+            num_entries = max_num_nodes * max_num_nodes * adj.size()[0]
+        else:
+            num_entries = np.sum(batch_num_nodes * batch_num_nodes)
+            embedding_mask = self.construct_mask(max_num_nodes, batch_num_nodes)
+            adj_mask = embedding_mask @ torch.transpose(embedding_mask, 1, 2)
+            link_loss[(1-adj_mask).bool()] = 0.0
+
+        return torch.sum(link_loss) / float(num_entries)
+
+    def chunked_link_loss(self, adj, batch_num_nodes, adj_hop=1):
+        ''' Same loss as dense_link_loss, computed over blocks of linkpred_chunk rows of the
+        predicted adjacency matrix. Each block is recomputed in the backward pass
+        (checkpointing), so only one [batch_size x linkpred_chunk x max_num_nodes] block is
+        alive at a time.
+        '''
+        max_num_nodes = adj.size()[1]
+        assign_hops, assign = self.link_pred_factors(adj_hop)
+        assign_t = torch.transpose(assign, 1, 2)
+        if batch_num_nodes is None:
+            num_entries = max_num_nodes * max_num_nodes * adj.size()[0]
+            mask = torch.ones(adj.size()[0], max_num_nodes, 1, dtype=assign.dtype,
+                    device=assign.device)
+        else:
+            num_entries = np.sum(batch_num_nodes * batch_num_nodes)
+            mask = self.construct_mask(max_num_nodes, batch_num_nodes).to(assign.dtype)
+        col_mask = torch.transpose(mask, 1, 2)
+
+        link_loss = 0
+        for lo in range(0, max_num_nodes, self.linkpred_chunk):
+            hi = min(lo + self.linkpred_chunk, max_num_nodes)
+            if adj.layout != torch.strided:
+                rows = torch.arange(lo, hi, device=adj.device)
+                adj_rows = torch.index_select(adj, 1, rows).to_dense()
+            else:
+                adj_rows = adj[:, lo:hi]
+            link_loss = link_loss + torch.utils.checkpoint.checkpoint(_link_loss_block,
+                    assign_hops[:, lo:hi], assign_t, adj_rows.to(assign.dtype), mask[:, lo:hi],
+                    col_mask, use_reentrant=False)
+        return link_loss / float(num_entries)
+
+    def sampled_link_loss(self, adj, batch_num_nodes, adj_hop=1):
+        ''' Estimate of the loss of dense_link_loss from the entries of all edges and from
+        linkpred_neg_ratio times as many node pairs sampled uniformly, so that its cost grows
+        with the number of edges instead of max_num_nodes^2. The non-edge term of the sampled
+        pairs is scaled by the number of pairs over the number of samples.
+        '''
+        eps = 1e-7
+        batch_size, max_num_nodes = adj.size()[0], adj.size()[1]
+        assign_hops, assign = self.link_pred_factors(adj_hop)
+        if batch_num_nodes is None:
+            num_nodes = torch.full((batch_size,), max_num_nodes, dtype=torch.long)
+        else:
+            num_nodes = torch.as_tensor(np.asarray(batch_num_nodes), dtype=torch.long)
+        num_nodes = num_nodes.to(assign.device)
+        num_entries = int(torch.sum(num_nodes * num_nodes))
+
+        # edges, identified by their flat index (graph, row, col) in adj
+        if adj.layout != torch.strided:
+            adj = adj.coalesce()
+            edges, edge_values = adj.indices(), adj.values()
+        else:
+            edges = torch.nonzero(adj, as_tuple=False).t()
+            edge_values = adj[edges[0], edges[1], edges[2]]
+        edge_keys = (edges[0] * max_num_nodes + edges[1]) * max_num_nodes + edges[2]
+        edge_keys, order = torch.sort(edge_keys)
+        edges, edge_values = edges[:, order], edge_values[order].to(assign.dtype)
+
+        def pred_adj(graphs, rows, cols):
+            pred = torch.sum(assign_hops[graphs, rows] * assign[graphs, cols], dim=1)
+            return torch.clamp(pred.float(), max=1)
+
+        pos_loss = torch.sum(-edge_values * torch.log(pred_adj(edges[0], edges[1], edges[2]) + eps))
+
+        num_samples = max(1, int(self.linkpred_neg_ratio * edges.size(1)))
+        graphs = torch.multinomial((num_nodes * num_nodes).float(), num_samples, replacement=True)
+        rows = (torch.rand(num_samples, device=assign.device) * num_nodes[graphs]).long()
+        cols = (torch.rand(num_samples, device=assign.device) * num_nodes[graphs]).long()
+        # target of the sampled pairs: value of the edge with the same key, or 0
+        keys = (graphs * max_num_nodes + rows) * max_num_nodes + cols
+        pos = torch.clamp(torch.searchsorted(edge_keys, keys), max=max(len(edge_keys) - 1, 0))
+        target = torch.zeros(num_samples, dtype=assign.dtype, device=assign.device)
+        if len(edge_keys) > 0:
+            target = torch.where(edge_keys[pos] == keys, edge_values[pos], target)
+        neg_loss = torch.sum(-(1 - target) * torch.log(1 - pred_adj(graphs, rows, cols) + eps))
+        neg_loss = neg_loss * (num_entries / float(num_samples))
+
+        return (pos_loss + neg_loss) / float(num_entries)
+
+def _link_loss_block(assign_hops_rows, assign_t, adj_rows, row_mask, col_mask):
+    ''' Link prediction loss summed over a block of rows of the predicted adjacency matrix.
+    '''
+    eps = 1e-7
+    # the log terms in float32 under bf16 autocast
+    pred_adj = torch.clamp((assign_hops_rows @ assign_t).float(), max=1)
+    link_loss = -adj_rows * torch.log(pred_adj+eps) - (1-adj_rows) * torch.log(1-pred_adj+eps)
+    return torch.sum(link_loss * row_mask * col_mask)
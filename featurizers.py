@@ -0,0 +1,129 @@
+import numpy as np
+
+import hashlib
+import os
+
+# Node featurizers, computed over all graphs of a dataset at once.
+# A featurizer takes a load_data.GraphArrays (and keyword parameters) and returns a
+# [num_nodes x dim] float matrix with one row per node of the dataset.
+FEATURIZERS = {}
+
+# Node features selected by --feature: list of (featurizer, params) whose outputs are
+# concatenated
+FEATURE_SETS = {
+        'deg-num': [('degree', {})],
+        'deg': [('degree_onehot', {'max_deg': 10}), ('node_feat', {})],
+        'struct': [('degree_onehot', {'max_deg': 10}), ('clustering', {}), ('node_feat', {})],
+}
+
+def register(name):
+    ''' Decorator adding a featurizer to FEATURIZERS under name.
+    '''
+    def wrapper(fn):
+        FEATURIZERS[name] = fn
+        return fn
+    return wrapper
+
+def binary_adj(data):
+    ''' Unweighted adjacency matrix of all graphs, without self-loops.
+    '''
+    adj = data.csr(dtype=np.float64)
+    adj.data[:] = 1
+    adj.setdiag(0)
+    adj.eliminate_zeros()
+    return adj
+
+@register('degree')
+def degree(data):
+    ''' (Weighted) degree of each node. Self-loops count once.
+    '''
+    deg = np.bincount(data.rows(), weights=data.weights(dtype=np.float64),
+            minlength=len(data.indptr) - 1)
+    return deg[:, np.newaxis]
+
+@register('degree_onehot')
+def degree_onehot(data, max_deg=10):
+    ''' One-hot encoding of the degree, degrees above max_deg falling in the last bucket.
+    '''
+    degs = np.minimum(degree(data)[:, 0].astype(int), max_deg)
+    feat = np.zeros((len(degs), max_deg + 1))
+    feat[np.arange(len(degs)), degs] = 1
+    return feat
+
+@register('clustering')
+def clustering(data):
+    ''' Local clustering coefficient of each node (as nx.clustering of unweighted graphs),
+    from the triangle counts diag(A^3) / 2.
+    '''
+    adj = binary_adj(data)
+    triangles = np.asarray(adj.dot(adj).multiply(adj).sum(axis=1)).ravel() / 2
+    degs = np.asarray(adj.sum(axis=1)).ravel()
+    pairs = degs * (degs - 1) / 2
+    coef = np.zeros(len(degs))
+    np.divide(triangles, pairs, out=coef, where=pairs > 0)
+    return coef[:, np.newaxis]
+
+@register('node_feat')
+def node_feat(data):
+    ''' The node attributes of the dataset ('feat' of the networkx graphs), or no columns if
+    there are none.
+    '''
+    if data.node_attrs is None:
+        return np.zeros((len(data.indptr) - 1, 0))
+    return np.asarray(data.node_attrs, dtype=np.float64)
+
+def dataset_key(data):
+    ''' Content hash of the graphs and node attributes of a dataset.
+    '''
+    h = hashlib.sha1()
+    for arr in [data.indptr, data.indices, data.node_offsets, data.edge_weights, data.node_attrs]:
+        if arr is not None:
+            arr = np.ascontiguousarray(arr)
+            h.update(('%s%s;' % (arr.dtype.str, arr.shape)).encode())
+            h.update(arr.data)
+    return h.hexdigest()[:16]
+
+def featurize(data, name, cache_dir=None, key=None, **params):
+    ''' Run one featurizer, reusing its result from cache_dir when it was computed before for
+    the same dataset and parameters.
+
+    Args:
+        key: dataset key of the cache files. Default to dataset_key(data).
+    Returns:
+        [num_nodes x dim] feature matrix
+    '''
+    if cache_dir is None:
+        return FEATURIZERS[name](data, **params)
+    if key is None:
+        key = dataset_key(data)
+    suffix = ''.join('_%s=%s' % (k, params[k]) for k in sorted(params))
+    filename = os.path.join(cache_dir, '%s_%s%s.npy' % (key, name, suffix))
+    if os.path.isfile(filename):
+        return np.load(filename)
+    feat = FEATURIZERS[name](data, **params)
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_filename = filename + '.tmp%d.npy' % os.getpid()
+    np.save(tmp_filename, feat)
+    os.replace(tmp_filename, filename)
+    return feat
+
+def compute_features(data, features, cache_dir=None, key=None):
+    ''' Node features of a dataset, as selected by --feature (a key of FEATURE_SETS).
+
+    Args:
+        data: load_data.GraphArrays.
+        cache_dir: directory of cached featurizer outputs, or None to always compute them.
+        key: dataset key of the cache files. Default to data.key, or to dataset_key(data) if
+            the dataset has none.
+    Returns:
+        [num_nodes x feat_dim] feature matrix
+    '''
+    if key is None:
+        key = data.key
+    if key is None and cache_dir is not None:
+        key = dataset_key(data)
+    # the node attributes are not computed, and may not be those of the source dataset (see
+    # graph_sampler.add_dataset_features), so they are not cached
+    return np.hstack([featurize(data, name, cache_dir=None if name == 'node_feat' else cache_dir,
+                                key=key, **params)
+                      for name, params in FEATURE_SETS[features]])
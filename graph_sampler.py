@@ -3,110 +3,737 @@ import numpy as np
 import torch
 import torch.utils.data
 
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import functools
+import os
+import queue
+import threading
+import time
+
+import featurizers
+import load_data
 import util
 
+def featurize_graph(G, features='default', max_num_nodes=0, feat_dim=0):
+    ''' Compute the adjacency matrix and the (padded) feature matrices of one graph.
+    Graphs are independent, so this can run in a worker pool.
+
+    The identity features of features='id' (and of the assignment features) are the same for
+    every graph and are not materialized here: their columns are left out (feat has no columns
+    for 'id' features) and GraphSampler.collate fills them in. Structural features ('deg',
+    'deg-num', 'struct') are computed over the whole dataset by featurizers, and label indices
+    ('label') are taken from the node labels of the whole dataset, so they have no columns here
+    either.
+
+    Returns:
+        adj (not normalized), feature matrix and assignment feature matrix of G
+    '''
+    adj = np.array(nx.to_numpy_matrix(G))
+    # feat matrix: max_num_nodes x feat_dim
+    if features == 'default':
+        f = np.zeros((max_num_nodes, feat_dim), dtype=float)
+        for i,u in enumerate(G.nodes()):
+            f[i,:] = util.node_dict(G)[u]['feat']
+        feat = f
+    elif features == 'id':
+        feat = np.zeros((max_num_nodes, 0))
+    else:
+        # dataset-wide features, see featurizers.FEATURE_SETS
+        feat = np.zeros((max_num_nodes, 0))
+
+    return adj, feat, feat
+
+def normalize_adj(adj, deg):
+    ''' Symmetric normalization D^-1/2 A D^-1/2 of adj, given the degree vector.
+    '''
+    sqrt_deg = 1.0 / np.sqrt(deg)
+    return adj * sqrt_deg[:, np.newaxis] * sqrt_deg[np.newaxis, :]
+
+def add_dataset_features(graphs, data, args):
+    ''' Compute the structural features selected by args.feature_type (a key of
+    featurizers.FEATURE_SETS) once over a whole dataset, in file order, and store the rows of
+    each graph in its 'node_features' graph attribute, where GraphSampler finds them for any
+    split of the graphs. As when GraphSampler computes them over its own graphs, the node
+    features are the 'feat' node attributes, so this is called once they are set. With
+    args.cache, the structural features are cached across runs under the key of the dataset
+    (see load_data.load_graphfile_cached).
+
+    Args:
+        graphs: load_data.to_networkx(data), with their 'feat' node attributes.
+        data: load_data.GraphArrays.
+    '''
+    if args.feature_type not in featurizers.FEATURE_SETS:
+        return
+    node_attrs = None
+    if 'feat' in util.node_dict(graphs[0])[0]:
+        node_attrs = np.vstack([np.asarray(feat, dtype=float) for G in graphs
+                                for _, feat in G.nodes(data='feat')])
+    data = load_data.GraphArrays(data.indptr, data.indices, data.node_offsets,
+            data.graph_labels, node_labels=data.node_labels, node_attrs=node_attrs,
+            num_node_labels=data.num_node_labels, edge_weights=data.edge_weights, key=data.key)
+    cache_dir = None
+    if args.cache and data.key is not None:
+        cache_dir = os.path.join(args.cache_dir if args.cache_dir is not None else
+                os.path.join(args.datadir, 'cache'), 'features')
+    feat = featurizers.compute_features(data, args.feature_type, cache_dir=cache_dir)
+    for G, lo, hi in zip(graphs, data.node_offsets[:-1], data.node_offsets[1:]):
+        G.graph['node_features'] = feat[lo:hi]
+
+def build_sampler(G_list, args, max_nodes=0, split=None):
+    ''' GraphSampler configured from the command line arguments.
+
+    Args:
+        split: name of the dataset split, used for its storage directory.
+    '''
+    storage_dir = None
+    if args.storage_dir is not None and split is not None:
+        storage_dir = os.path.join(args.storage_dir, split)
+    dataset_sampler = GraphSampler(G_list, normalize=False, max_num_nodes=max_nodes,
+            features=args.feature_type, num_workers=args.sampler_workers, pool=args.sampler_pool,
+            storage_dir=storage_dir, feat_dtype=args.feat_dtype, adj_storage=args.adj_storage)
+    dataset_sampler.pad_to_batch_max = args.bucket
+    dataset_sampler.sparse_adj = args.sparse_adj
+    if args.num_workers > 0:
+        dataset_sampler.share_memory()
+    return dataset_sampler
+
+def build_loader(dataset, args, shuffle=True, batch_size=None):
+    ''' DataLoader over a GraphSampler, or a torch.utils.data.Subset of one, configured from the
+    command line arguments. With args.bucket, batches are formed by BucketBatchSampler. With
+    args.packed, the graphs of a batch are concatenated (see GraphSampler.collate_packed).
+
+    Args:
+        batch_size: default to args.batch_size.
+    '''
+    if batch_size is None:
+        batch_size = args.batch_size
+    if isinstance(dataset, torch.utils.data.Subset):
+        dataset_sampler = dataset.dataset
+        num_nodes = dataset_sampler.len_all[dataset.indices]
+    else:
+        dataset_sampler = dataset
+        num_nodes = dataset_sampler.len_all
+    collate_fn = dataset_sampler.collate_packed if args.packed else dataset_sampler.collate
+    if not args.bucket:
+        return torch.utils.data.DataLoader(
+                dataset,
+                batch_size=batch_size,
+                shuffle=shuffle,
+                num_workers=args.num_workers,
+                collate_fn=collate_fn)
+    batch_sampler = BucketBatchSampler(num_nodes, batch_size, shuffle=shuffle,
+            max_cost=args.batch_cost)
+    print('Padding waste: {0:.3f} (padding to max_num_nodes: {1:.3f})'.format(
+            batch_sampler.padding_waste(), batch_sampler.padding_waste(
+                    num_nodes_pad=dataset_sampler.max_num_nodes)))
+    return torch.utils.data.DataLoader(
+            dataset,
+            batch_sampler=batch_sampler,
+            num_workers=args.num_workers,
+            collate_fn=collate_fn)
+
+class BucketBatchSampler(torch.utils.data.Sampler):
+    ''' Batches of graphs of similar sizes, so that little is lost to padding when they are
+    padded to their largest graph (GraphSampler.pad_to_batch_max).
+
+    Each epoch, the graphs are shuffled and split into pools of pool_batches batches. The graphs
+    of each pool are sorted by size and cut into batches, and the batches are shuffled. Without
+    shuffle, all graphs are sorted by size.
+    '''
+    def __init__(self, num_nodes, batch_size, shuffle=True, max_cost=None, pool_batches=50):
+        '''
+        Args:
+            num_nodes: number of nodes of each graph of the dataset.
+            max_cost: if given, batches have a variable number of graphs, as many as fit in
+                batch_size * N^2 <= max_cost, N being the number of nodes of the batch after
+                padding (i.e. the sum of N^2 over the padded graphs, the cost of the dense
+                adjacency products). batch_size is then ignored.
+        '''
+        self.num_nodes = np.asarray(num_nodes, dtype=np.int64)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.max_cost = max_cost
+        self.pool_batches = pool_batches
+        # batches of the next epoch, drawn in advance when __len__ is called first
+        self.batches = None
+
+    def _split(self, pool):
+        ''' Cut a pool of graphs sorted by size into batches.
+        '''
+        if self.max_cost is None:
+            return [pool[i:i + self.batch_size] for i in range(0, len(pool), self.batch_size)]
+        batches = []
+        start = 0
+        for i, n in enumerate(self.num_nodes[pool]):
+            # graphs are sorted by size, so the last one sets the padding
+            if i > start and (i - start + 1) * n * n > self.max_cost:
+                batches.append(pool[start:i])
+                start = i
+        batches.append(pool[start:])
+        return batches
+
+    def make_batches(self):
+        ''' Draw the batches of an epoch.
+        '''
+        num_graphs = len(self.num_nodes)
+        if self.shuffle:
+            order = torch.randperm(num_graphs).numpy()
+            pool_size = self.batch_size * self.pool_batches
+        else:
+            order = np.arange(num_graphs)
+            pool_size = max(num_graphs, 1)
+        batches = []
+        for lo in range(0, num_graphs, pool_size):
+            pool = order[lo:lo + pool_size]
+            pool = pool[np.argsort(self.num_nodes[pool], kind='stable')]
+            batches.extend(self._split(pool))
+        if self.shuffle:
+            batches = [batches[i] for i in torch.randperm(len(batches)).tolist()]
+        return batches
+
+    def padding_waste(self, batches=None, num_nodes_pad=None):
+        ''' Fraction of the padded adjacency entries that are padding.
+
+        Args:
+            batches: batches to evaluate. Default to those of the next epoch.
+            num_nodes_pad: if given, evaluate padding every graph to num_nodes_pad nodes
+                instead of to the largest graph of its batch.
+        '''
+        if batches is None:
+            if self.batches is None:
+                self.batches = self.make_batches()
+            batches = self.batches
+        real = float(np.sum(self.num_nodes ** 2))
+        if num_nodes_pad is not None:
+            padded = float(len(self.num_nodes) * num_nodes_pad ** 2)
+        else:
+            padded = float(sum(len(b) * self.num_nodes[b].max() ** 2 for b in batches if len(b)))
+        return 1 - real / padded if padded > 0 else 0.0
+
+    def __iter__(self):
+        batches = self.batches if self.batches is not None else self.make_batches()
+        self.batches = None
+        for batch in batches:
+            yield batch.tolist()
+
+    def __len__(self):
+        if self.batches is None:
+            self.batches = self.make_batches()
+        return len(self.batches)
+
+class PrefetchLoader(object):
+    ''' Iterator over the batches of a DataLoader, collated and passed through prepare (e.g.
+    conversions and copies to the device) by a background thread up to depth batches ahead
+    of the consumer, so that the data preparation overlaps with the model steps. With depth=0,
+    batches are prepared in the consumer's thread when requested, as without prefetching.
+
+    stall_time is the time the consumer spent waiting for batches during the last pass: if it
+    is a large part of the epoch time, the input pipeline is the bottleneck.
+    '''
+    def __init__(self, loader, prepare=None, depth=2):
+        self.loader = loader
+        self.prepare = prepare if prepare is not None else (lambda data: data)
+        self.depth = depth
+        self.stall_time = 0.0
+        dataset = loader.dataset
+        if isinstance(dataset, torch.utils.data.Subset):
+            dataset = dataset.dataset
+        if isinstance(dataset, GraphSampler) and loader.num_workers == 0 and \
+                dataset.num_buffers > 0:
+            # batches collated in this process live in the ring of batch buffers (see
+            # GraphSampler.batch_buffers): the queued batches, the one being collated and the
+            # one in use must all have their own buffers
+            dataset.num_buffers = max(dataset.num_buffers, depth + 2)
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __iter__(self):
+        self.stall_time = 0.0
+        if self.depth == 0:
+            it = iter(self.loader)
+            while True:
+                begin_time = time.time()
+                try:
+                    data = self.prepare(next(it))
+                except StopIteration:
+                    return
+                finally:
+                    self.stall_time += time.time() - begin_time
+                yield data
+
+        batches = queue.Queue(maxsize=self.depth)
+        stop = threading.Event()
+        end = object()
+
+        def put(item):
+            # give up when the consumer stopped iterating
+            while not stop.is_set():
+                try:
+                    batches.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def produce():
+            try:
+                for data in self.loader:
+                    if not put((self.prepare(data), None)):
+                        return
+                put((end, None))
+            except Exception as e:
+                put((end, e))
+
+        thread = threading.Thread(target=produce, daemon=True)
+        thread.start()
+        try:
+            while True:
+                begin_time = time.time()
+                data, error = batches.get()
+                self.stall_time += time.time() - begin_time
+                if data is end:
+                    if error is not None:
+                        raise error
+                    return
+                yield data
+        finally:
+            stop.set()
+            thread.join()
+
 class GraphSampler(torch.utils.data.Dataset):
     ''' Sample graphs and nodes in graph
+
+    The adjacency blocks and the (unpadded) feature rows of all graphs are packed into a few
+    contiguous arrays indexed by offsets, optionally backed by np.memmap files. __getitem__
+    returns views into them, and collate pads a batch to max_num_nodes into reusable batch
+    buffers.
     '''
-    def __init__(self, G_list, features='default', normalize=True, assign_feat='default', max_num_nodes=0):
-        self.adj_all = []
-        self.len_all = []
-        self.feature_all = []
-        self.label_all = []
-        
-        self.assign_feat_all = []
+    def __init__(self, G_list, features='default', normalize=True, assign_feat='default', max_num_nodes=0,
+            num_workers=1, pool='process', storage_dir=None, dtype=np.float32, feat_dtype=None,
+            adj_storage='dense'):
+        '''
+        Args:
+            num_workers: number of workers featurizing graphs in parallel. The graphs are
+                processed serially if num_workers <= 1.
+            pool: 'process' or 'thread' worker pool.
+            storage_dir: if given, the arrays are stored in .npy files in this directory and
+                memory-mapped, so that datasets larger than RAM are paged in on demand.
+            dtype: dtype of the stored adjacency and of the emitted batches.
+            feat_dtype: dtype of the stored features, e.g. np.float16 to halve their memory.
+                Default to dtype. Features are converted to dtype when collated.
+            adj_storage: how adjacency matrices are stored until they are expanded to dense
+                blocks by collate. 'dense': float matrices; 'packbits': bit-packed matrices
+                (np.packbits); 'edgelist': (row, col) pairs of the nonzero entries. The last two
+                only hold unweighted graphs; with normalize, the degree vectors are stored
+                separately and the normalization is applied at collate time.
+
+        The dataset-wide structural features (featurizers.FEATURE_SETS) are taken from the
+        'node_features' graph attribute set by add_dataset_features, or computed over G_list if
+        the graphs do not have it.
+
+        With features='id' or assign_feat='id', the identity columns are not stored but
+        generated by collate, in front of the stored features.
+
+        With features='label', the features are the one-hot node labels, but only the label
+        indices are stored and emitted: feats and assign_feats are [... x 1] int64 tensors of
+        1-based labels, 0 marking padding nodes, that GraphConv takes in place of the one-hot
+        rows. feat_dim is the number of labels.
+        '''
+        self.storage_dir = storage_dir
+        self.shared = {}
+        self.normalize = normalize
+        self.adj_storage = adj_storage
+        # number of identity columns generated at collate time
+        self.id_feat_dim = 0
+        self.id_assign_feat_dim = 0
+        self.dtype = np.dtype(dtype)
+        self.feat_dtype = self.dtype if feat_dtype is None else np.dtype(feat_dtype)
+        # ring of reusable batch buffers, see collate
+        self.num_buffers = 2
+        self.buffers = []
+        self.next_buffer = 0
+        # pad each batch to its largest graph rather than to max_num_nodes
+        self.pad_to_batch_max = False
+        # emit the adjacency matrices of padded batches as a sparse tensor
+        self.sparse_adj = False
+        if storage_dir is not None:
+            os.makedirs(storage_dir, exist_ok=True)
+
+        self.len_all = np.array([G.number_of_nodes() for G in G_list], dtype=np.int64)
+        self.label_all = np.array([G.graph['label'] for G in G_list])
+        # nodes of graph i are rows node_offsets[i]:node_offsets[i+1] of the feature arrays,
+        # its adjacency is adj_data[adj_offsets[i]:adj_offsets[i+1]] (flattened, packed bits or
+        # edge list depending on adj_storage)
+        self.node_offsets = np.concatenate([[0], np.cumsum(self.len_all)])
+        if adj_storage == 'dense':
+            adj_sizes = self.len_all ** 2
+        elif adj_storage == 'packbits':
+            adj_sizes = (self.len_all ** 2 + 7) // 8
+        elif adj_storage == 'edgelist':
+            adj_sizes = np.array([2 * G.number_of_edges() - nx.number_of_selfloops(G)
+                                  for G in G_list], dtype=np.int64)
+        else:
+            raise ValueError('Unknown adjacency storage: ' + str(adj_storage))
+        self.adj_offsets = np.concatenate([[0], np.cumsum(adj_sizes)])
 
         if max_num_nodes == 0:
             self.max_num_nodes = max([G.number_of_nodes() for G in G_list])
         else:
             self.max_num_nodes = max_num_nodes
+        self.label_index = features == 'label'
+        if features == 'id':
+            self.id_feat_dim = self.max_num_nodes
+        # assign_feat='id' puts identity columns in front of the features
+        self.id_assign_feat_dim = self.id_feat_dim
+        if assign_feat == 'id':
+            self.id_assign_feat_dim += self.max_num_nodes
+
+        self.feat_dim = 0
+        if features == 'default':
+            self.feat_dim = util.node_dict(G_list[0])[0]['feat'].shape[0]
 
-        #if features == 'default':
-        self.feat_dim = util.node_dict(G_list[0])[0]['feat'].shape[0]
-
-        for G in G_list:
-            adj = np.array(nx.to_numpy_matrix(G))
-            if normalize:
-                sqrt_deg = np.diag(1.0 / np.sqrt(np.sum(adj, axis=0, dtype=float).squeeze()))
-                adj = np.matmul(np.matmul(sqrt_deg, adj), sqrt_deg)
-            self.adj_all.append(adj)
-            self.len_all.append(G.number_of_nodes())
-            self.label_all.append(G.graph['label'])
-            # feat matrix: max_num_nodes x feat_dim
-            if features == 'default':
-                f = np.zeros((self.max_num_nodes, self.feat_dim), dtype=float)
-                for i,u in enumerate(G.nodes()):
-                    f[i,:] = util.node_dict(G)[u]['feat']
-                self.feature_all.append(f)
-            elif features == 'id':
-                self.feature_all.append(np.identity(self.max_num_nodes))
-            elif features == 'deg-num':
-                degs = np.sum(np.array(adj), 1)
-                degs = np.expand_dims(np.pad(degs, [0, self.max_num_nodes - G.number_of_nodes()], 0),
-                                      axis=1)
-                self.feature_all.append(degs)
-            elif features == 'deg':
-                self.max_deg = 10
-                degs = np.sum(np.array(adj), 1).astype(int)
-                degs[degs>max_deg] = max_deg
-                feat = np.zeros((len(degs), self.max_deg + 1))
-                feat[np.arange(len(degs)), degs] = 1
-                feat = np.pad(feat, ((0, self.max_num_nodes - G.number_of_nodes()), (0, 0)),
-                        'constant', constant_values=0)
-
-                f = np.zeros((self.max_num_nodes, self.feat_dim), dtype=float)
-                for i,u in enumerate(util.node_iter(G)):
-                    f[i,:] = util.node_dict(G)[u]['feat']
-
-                feat = np.concatenate((feat, f), axis=1)
-
-                self.feature_all.append(feat)
-            elif features == 'struct':
-                self.max_deg = 10
-                degs = np.sum(np.array(adj), 1).astype(int)
-                degs[degs>10] = 10
-                feat = np.zeros((len(degs), self.max_deg + 1))
-                feat[np.arange(len(degs)), degs] = 1
-                degs = np.pad(feat, ((0, self.max_num_nodes - G.number_of_nodes()), (0, 0)),
-                        'constant', constant_values=0)
-
-                clusterings = np.array(list(nx.clustering(G).values()))
-                clusterings = np.expand_dims(np.pad(clusterings, 
-                                                    [0, self.max_num_nodes - G.number_of_nodes()],
-                                                    'constant'),
-                                             axis=1)
-                g_feat = np.hstack([degs, clusterings])
-                if 'feat' in util.node_dict(G)[0]:
-                    node_feats = np.array([util.node_dict(G)[i]['feat'] for i in range(G.number_of_nodes())])
-                    node_feats = np.pad(node_feats, ((0, self.max_num_nodes - G.number_of_nodes()), (0, 0)),
-                                        'constant')
-                    g_feat = np.hstack([g_feat, node_feats])
-
-                self.feature_all.append(g_feat)
-
-            if assign_feat == 'id':
-                self.assign_feat_all.append(
-                        np.hstack((np.identity(self.max_num_nodes), self.feature_all[-1])) )
+        featurize = functools.partial(featurize_graph, features=features,
+                max_num_nodes=self.max_num_nodes, feat_dim=self.feat_dim)
+        if adj_storage == 'dense':
+            self.adj_data = self._alloc('adj', (self.adj_offsets[-1],), self.dtype)
+        elif adj_storage == 'packbits':
+            self.adj_data = self._alloc('adj', (self.adj_offsets[-1],), np.uint8)
+        else:
+            self.adj_data = self._alloc('adj', (self.adj_offsets[-1], 2),
+                    np.uint16 if self.max_num_nodes <= 65536 else np.int64)
+        # degrees, for the normalization of the compact adjacency storages
+        self.deg_data = None
+        if normalize and not adj_storage == 'dense':
+            self.deg_data = self._alloc('deg', (self.node_offsets[-1],), self.dtype)
+        self.feature_data = None
+        self.assign_feat_data = None
+        if num_workers > 1:
+            executor_cls = ProcessPoolExecutor if pool == 'process' else ThreadPoolExecutor
+            # map returns the results in input order
+            with executor_cls(max_workers=num_workers) as executor:
+                self._pack(executor.map(featurize, G_list,
+                        chunksize=max(1, len(G_list) // (4 * num_workers))))
+        else:
+            self._pack(map(featurize, G_list))
+        if features in featurizers.FEATURE_SETS:
+            if all('node_features' in G.graph for G in G_list):
+                feat = np.concatenate([G.graph['node_features'] for G in G_list])
             else:
-                self.assign_feat_all.append(self.feature_all[-1])
-            
-        self.feat_dim = self.feature_all[0].shape[1]
-        self.assign_feat_dim = self.assign_feat_all[0].shape[1]
+                feat = featurizers.compute_features(load_data.from_networkx(G_list), features)
+            self.feature_data = self._alloc('feats', feat.shape, self.feat_dtype)
+            self.feature_data[:] = feat
+            self.assign_feat_data = self.feature_data
+        elif self.label_index:
+            if self.id_assign_feat_dim > 0:
+                raise ValueError('Label index features cannot be combined with identity features')
+            data = load_data.from_networkx(G_list)
+            if data.node_labels is None:
+                raise ValueError('Label index features require node labels')
+            label_dtype = np.int16 if data.num_node_labels < np.iinfo(np.int16).max else np.int32
+            self.feature_data = self._alloc('feats', (self.node_offsets[-1], 1), label_dtype)
+            self.feature_data[:, 0] = data.node_labels + 1
+            self.assign_feat_data = self.feature_data
+
+        # columns and dtype of the collated features
+        self.feat_cols = self.id_feat_dim + self.feature_data.shape[1]
+        self.assign_feat_cols = self.id_assign_feat_dim + self.assign_feat_data.shape[1]
+        self.batch_feat_dtype = np.dtype(np.int64) if self.label_index else self.dtype
+        if self.label_index:
+            self.feat_dim = self.assign_feat_dim = data.num_node_labels
+        else:
+            self.feat_dim = self.feat_cols
+            self.assign_feat_dim = self.assign_feat_cols
+
+    def _alloc(self, name, shape, dtype):
+        if self.storage_dir is None or np.prod(shape) == 0:
+            return np.zeros(shape, dtype=dtype)
+        return np.lib.format.open_memmap(os.path.join(self.storage_dir, name + '.npy'),
+                mode='w+', dtype=dtype, shape=shape)
+
+    def _pack(self, results):
+        ''' Copy the featurized graphs into the contiguous arrays as they are produced.
+        '''
+        num_nodes_total = self.node_offsets[-1]
+        for i, (adj, feat, assign) in enumerate(results):
+            num_nodes = self.len_all[i]
+            if self.feature_data is None:
+                self.feature_data = self._alloc('feats', (num_nodes_total, feat.shape[1]),
+                        self.feat_dtype)
+                # the assignment features are usually the features themselves
+                if assign is feat:
+                    self.assign_feat_data = self.feature_data
+                else:
+                    self.assign_feat_data = self._alloc('assign_feats',
+                            (num_nodes_total, assign.shape[1]), self.feat_dtype)
+            lo, hi = self.node_offsets[i], self.node_offsets[i+1]
+            adj_lo, adj_hi = self.adj_offsets[i], self.adj_offsets[i+1]
+            if self.adj_storage == 'dense':
+                if self.normalize:
+                    adj = normalize_adj(adj, np.sum(adj, axis=0, dtype=float))
+                self.adj_data[adj_lo:adj_hi] = adj.reshape(-1)
+            else:
+                if not np.all((adj == 0) | (adj == 1)):
+                    raise ValueError('Adjacency storage %s requires unweighted graphs' %
+                            self.adj_storage)
+                if self.adj_storage == 'packbits':
+                    self.adj_data[adj_lo:adj_hi] = np.packbits(adj.reshape(-1) != 0)
+                else:
+                    self.adj_data[adj_lo:adj_hi] = np.argwhere(adj)
+                if self.deg_data is not None:
+                    self.deg_data[lo:hi] = np.sum(adj, axis=0)
+            self.feature_data[lo:hi] = feat[:num_nodes]
+            if self.assign_feat_data is not self.feature_data:
+                self.assign_feat_data[lo:hi] = assign[:num_nodes]
+
+    def share_memory(self):
+        ''' Move the packed arrays to shared memory, so that DataLoader workers (and datasets
+        indexing into this one, such as the cross validation folds) use a single copy of them
+        instead of copying pages touched through refcount updates. Memory-mapped arrays are
+        already shared through the page cache and are left as they are.
+        '''
+        for name in ['adj_data', 'deg_data', 'feature_data', 'assign_feat_data']:
+            arr = getattr(self, name)
+            if arr is None or isinstance(arr, np.memmap) or name in self.shared:
+                continue
+            if name == 'assign_feat_data' and arr is self.feature_data:
+                self.shared[name] = self.shared.get('feature_data')
+            else:
+                self.shared[name] = torch.from_numpy(arr).share_memory_()
+            if self.shared[name] is None:
+                del self.shared[name]
+            else:
+                setattr(self, name, self.shared[name].numpy())
+        return self
+
+    def __getstate__(self):
+        # shared arrays are sent as their (shared memory) tensors when pickled for workers
+        state = self.__dict__.copy()
+        for name in self.shared:
+            state[name] = None
+        state['buffers'] = []
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        for name, tensor in self.shared.items():
+            setattr(self, name, tensor.numpy())
 
     def __len__(self):
-        return len(self.adj_all)
+        return len(self.len_all)
 
     def __getitem__(self, idx):
-        adj = self.adj_all[idx]
-        num_nodes = adj.shape[0]
-        adj_padded = np.zeros((self.max_num_nodes, self.max_num_nodes))
-        adj_padded[:num_nodes, :num_nodes] = adj
+        num_nodes = self.len_all[idx]
+        lo, hi = self.node_offsets[idx], self.node_offsets[idx+1]
+
+        adj = self.adj_data[self.adj_offsets[idx]:self.adj_offsets[idx+1]]
+        if self.adj_storage == 'dense':
+            adj = adj.reshape(num_nodes, num_nodes)
 
         # use all nodes for aggregation (baseline)
 
-        return {'adj':adj_padded,
-                'feats':self.feature_all[idx].copy(),
+        item = {'adj':adj,
+                'feats':self.feature_data[lo:hi],
                 'label':self.label_all[idx],
                 'num_nodes': num_nodes,
-                'assign_feats':self.assign_feat_all[idx].copy()}
+                'assign_feats':self.assign_feat_data[lo:hi]}
+        if self.deg_data is not None:
+            item['deg'] = self.deg_data[lo:hi]
+        return item
+
+    def expand_adj(self, item, out):
+        ''' Write the dense adjacency block of a graph returned by __getitem__ into out, an
+        all-zero [num_nodes x num_nodes] array.
+        '''
+        num_nodes = item['num_nodes']
+        if self.adj_storage == 'dense':
+            out[...] = item['adj']
+            return
+        if self.adj_storage == 'packbits':
+            out[...] = np.unpackbits(item['adj'], count=num_nodes * num_nodes).reshape(
+                    num_nodes, num_nodes)
+        else:
+            out[item['adj'][:, 0], item['adj'][:, 1]] = 1
+        if self.deg_data is not None:
+            out[...] = normalize_adj(out, item['deg'])
+
+    def adj_entries(self, item):
+        ''' Nonzero entries (rows, cols, values) of the adjacency matrix of a graph returned by
+        __getitem__, in row-major order.
+        '''
+        num_nodes = item['num_nodes']
+        if self.adj_storage == 'dense':
+            rows, cols = np.nonzero(item['adj'])
+            return rows, cols, item['adj'][rows, cols]
+        if self.adj_storage == 'packbits':
+            rows, cols = np.nonzero(np.unpackbits(item['adj'], count=num_nodes * num_nodes).reshape(
+                    num_nodes, num_nodes))
+        else:
+            rows, cols = item['adj'][:, 0].astype(np.int64), item['adj'][:, 1].astype(np.int64)
+        values = np.ones(len(rows), dtype=self.dtype)
+        if self.deg_data is not None:
+            values /= np.sqrt(item['deg'][rows] * item['deg'][cols])
+        return rows, cols, values
+
+    def sparse_adj_tensor(self, batch, num_nodes_pad=None):
+        ''' Adjacency matrices of a batch of graphs returned by __getitem__ as a sparse COO
+        tensor: [batch_size x num_nodes_pad x num_nodes_pad], or the [total_nodes x total_nodes]
+        block-diagonal matrix of the concatenated graphs if num_nodes_pad is None.
+        '''
+        num_nodes = np.array([item['num_nodes'] for item in batch], dtype=np.int64)
+        if num_nodes_pad is None:
+            node_offsets = np.concatenate([[0], np.cumsum(num_nodes)])
+        else:
+            node_offsets = np.zeros(len(batch), dtype=np.int64)
+        graphs, rows, cols, values = [], [], [], []
+        for i, (item, offset) in enumerate(zip(batch, node_offsets)):
+            item_rows, item_cols, item_values = self.adj_entries(item)
+            graphs.append(np.full(len(item_rows), i, dtype=np.int64))
+            rows.append(item_rows + offset)
+            cols.append(item_cols + offset)
+            values.append(item_values)
+        indices = [np.concatenate(rows), np.concatenate(cols)]
+        if num_nodes_pad is None:
+            size = (int(node_offsets[-1]),) * 2
+        else:
+            indices = [np.concatenate(graphs)] + indices
+            size = (len(batch), num_nodes_pad, num_nodes_pad)
+        return torch.sparse_coo_tensor(torch.from_numpy(np.vstack(indices)),
+                torch.from_numpy(np.concatenate(values).astype(self.dtype)), size).coalesce()
+
+    def batch_buffers(self, batch_size, num_nodes):
+        ''' Batch arrays of batch_size graphs padded to num_nodes nodes, to collate into. In the
+        main process they come from a ring of num_buffers preallocated buffers, so a batch stays
+        valid until num_buffers more batches have been collated. In DataLoader worker processes,
+        batches are handed over to the main process through shared memory, so fresh arrays are
+        allocated instead.
+        '''
+        shapes = {'adj': (num_nodes, num_nodes),
+                  'feats': (num_nodes, self.feat_cols),
+                  'assign_feats': (num_nodes, self.assign_feat_cols)}
+        dtypes = {'adj': self.dtype, 'feats': self.batch_feat_dtype,
+                  'assign_feats': self.batch_feat_dtype}
+        if self.sparse_adj:
+            del shapes['adj']
+        sizes = {name: batch_size * int(np.prod(shape)) for name, shape in shapes.items()}
+        reuse = self.num_buffers > 0 and torch.utils.data.get_worker_info() is None
+        buffers = None
+        if reuse:
+            slot = self.next_buffer % self.num_buffers
+            self.next_buffer += 1
+            if slot < len(self.buffers):
+                buffers = self.buffers[slot]
+        if buffers is not None and len(buffers['written']) >= batch_size:
+            if buffers['num_nodes'] == num_nodes:
+                return buffers
+            # a different padding (see pad_to_batch_max): lay the batch out again in the same
+            # memory, if it is large enough. The buffers keep all their rows, so that they always
+            # have as many as written
+            rows = len(buffers['written'])
+            rows_sizes = {name: rows * int(np.prod(shape)) for name, shape in shapes.items()}
+            if all(buffers['data'][name].size >= size for name, size in rows_sizes.items()):
+                for name, shape in shapes.items():
+                    data = buffers['data'][name]
+                    data[:rows_sizes[name]] = 0
+                    buffers[name] = data[:rows_sizes[name]].reshape((rows,) + shape)
+                buffers['written'][:] = 0
+                buffers['num_nodes'] = num_nodes
+                return buffers
+        data = {name: np.zeros(size, dtype=dtypes[name]) for name, size in sizes.items()}
+        buffers = {name: data[name].reshape((batch_size,) + shape)
+                   for name, shape in shapes.items()}
+        buffers['data'] = data
+        buffers['num_nodes'] = num_nodes
+        # number of nodes last written to each row of the buffers
+        buffers['written'] = np.zeros(batch_size, dtype=np.int64)
+        if reuse:
+            if slot < len(self.buffers):
+                self.buffers[slot] = buffers
+            else:
+                self.buffers.append(buffers)
+        return buffers
+
+    def collate(self, batch):
+        ''' Pad the graphs of a batch to max_num_nodes, or to the size of the largest graph of
+        the batch with pad_to_batch_max. Use as the collate_fn of a DataLoader.
+
+        The adj, feats and assign_feats tensors share memory with the batch buffers (see
+        batch_buffers); only the entries written by the previous use of a buffer are cleared.
+        Identity features are generated here rather than stored with each graph. With
+        sparse_adj, adj is a sparse [batch_size x num_nodes x num_nodes] tensor and no dense
+        adjacency is built.
+        '''
+        batch_size = len(batch)
+        if self.pad_to_batch_max:
+            num_nodes_pad = max(item['num_nodes'] for item in batch)
+        else:
+            num_nodes_pad = self.max_num_nodes
+        buffers = self.batch_buffers(batch_size, num_nodes_pad)
+        adj = buffers.get('adj')
+        feats = buffers['feats']
+        assign_feats = buffers['assign_feats']
+        written = buffers['written']
+        diag = np.arange(num_nodes_pad)
+        for i, item in enumerate(batch):
+            num_nodes = item['num_nodes']
+            if written[i] > 0:
+                if adj is not None:
+                    adj[i, :written[i], :written[i]] = 0
+                feats[i, :written[i]] = 0
+                assign_feats[i, :written[i]] = 0
+            if adj is not None:
+                self.expand_adj(item, adj[i, :num_nodes, :num_nodes])
+            # like the stored identity matrices, the identity features cover the padding rows
+            for offset in range(0, self.id_feat_dim, self.max_num_nodes):
+                feats[i, diag, offset + diag] = 1
+            feats[i, :num_nodes, self.id_feat_dim:] = item['feats']
+            for offset in range(0, self.id_assign_feat_dim, self.max_num_nodes):
+                assign_feats[i, diag, offset + diag] = 1
+            assign_feats[i, :num_nodes, self.id_assign_feat_dim:] = item['assign_feats']
+            written[i] = num_nodes
+        if adj is None:
+            adj = self.sparse_adj_tensor(batch, num_nodes_pad)
+        else:
+            adj = torch.from_numpy(adj[:batch_size])
+        return {'adj': adj,
+                'feats': torch.from_numpy(feats[:batch_size]),
+                'label': torch.from_numpy(np.array([item['label'] for item in batch])),
+                'num_nodes': torch.from_numpy(np.array([item['num_nodes'] for item in batch])),
+                'assign_feats': torch.from_numpy(assign_feats[:batch_size])}
+
+    def collate_packed(self, batch):
+        ''' Concatenate the graphs of a batch into one graph with a block-diagonal adjacency
+        matrix, instead of padding them. Use as the collate_fn of a DataLoader.
+
+        Returns:
+            adj: [total_nodes x total_nodes] sparse COO tensor.
+            feats, assign_feats: [total_nodes x dim] features of the nodes of all graphs.
+            batch: [total_nodes] index of the graph of each node.
+            label, num_nodes: as returned by collate.
+        '''
+        num_nodes = np.array([item['num_nodes'] for item in batch], dtype=np.int64)
+        node_offsets = np.concatenate([[0], np.cumsum(num_nodes)])
+        total_nodes = int(node_offsets[-1])
+        adj = self.sparse_adj_tensor(batch)
+
+        graph_index = np.repeat(np.arange(len(batch)), num_nodes)
+        # index of each node within its graph, for the identity features
+        local_index = np.arange(total_nodes) - node_offsets[graph_index]
+        all_nodes = np.arange(total_nodes)
+        feats = np.zeros((total_nodes, self.feat_cols), dtype=self.batch_feat_dtype)
+        for offset in range(0, self.id_feat_dim, self.max_num_nodes):
+            feats[all_nodes, offset + local_index] = 1
+        feats[:, self.id_feat_dim:] = np.concatenate([item['feats'] for item in batch])
+        assign_feats = np.zeros((total_nodes, self.assign_feat_cols),
+                dtype=self.batch_feat_dtype)
+        for offset in range(0, self.id_assign_feat_dim, self.max_num_nodes):
+            assign_feats[all_nodes, offset + local_index] = 1
+        assign_feats[:, self.id_assign_feat_dim:] = np.concatenate(
+                [item['assign_feats'] for item in batch])
+        return {'adj': adj,
+                'feats': torch.from_numpy(feats),
+                'label': torch.from_numpy(np.array([item['label'] for item in batch])),
+                'num_nodes': torch.from_numpy(num_nodes),
+                'assign_feats': torch.from_numpy(assign_feats),
+                'batch': torch.from_numpy(graph_index)}
 
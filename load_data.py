@@ -1,115 +1,579 @@
 import networkx as nx
 import numpy as np
-import scipy as sc
+import scipy.sparse as sp
+import hashlib
 import os
-import re
+import pickle
+import shutil
+from contextlib import ExitStack
 
-import util
+class GraphArrays(object):
+    ''' Compact array representation of a collection of graphs.
 
-def read_graphfile(datadir, dataname, max_nodes=None):
+    The adjacency matrices of all graphs are stored as a single block-diagonal CSR matrix with
+    global node ids (indexed from 0). The nodes of graph i are the contiguous range
+    node_offsets[i]:node_offsets[i+1].
+
+    Attributes:
+        indptr: [num_nodes + 1] CSR row pointers.
+        indices: [num_edges] CSR column indices (global node ids). Each undirected edge is
+            stored in both directions.
+        node_offsets: [num_graphs + 1] start of the node range of each graph.
+        graph_labels: [num_graphs] graph labels, mapped to consecutive ints.
+        node_labels: [num_nodes] node labels starting from 0, or None.
+        node_attrs: [num_nodes x attr_dim] node attributes, or None.
+        num_node_labels: number of distinct node labels (dimension of the one-hot encoding).
+        edge_weights: [num_edges] weight of each entry of indices, or None for unweighted graphs.
+        key: identifies the source of the dataset (see load_graphfile_cached), for caches of
+            values computed over it, or None.
+    '''
+    def __init__(self, indptr, indices, node_offsets, graph_labels, node_labels=None,
+            node_attrs=None, num_node_labels=None, edge_weights=None, key=None):
+        self.key = key
+        self.indptr = indptr
+        self.indices = indices
+        self.edge_weights = edge_weights
+        self.node_offsets = node_offsets
+        self.graph_labels = graph_labels
+        self.node_labels = node_labels
+        self.node_attrs = node_attrs
+        if num_node_labels is None and node_labels is not None and len(node_labels) > 0:
+            num_node_labels = int(node_labels.max()) + 1
+        self.num_node_labels = num_node_labels
+
+    def __len__(self):
+        return len(self.graph_labels)
+
+    def num_nodes(self):
+        ''' Number of nodes of each graph.
+        '''
+        return np.diff(self.node_offsets)
+
+    def num_edges(self):
+        ''' Number of undirected edges of each graph (self-loops count once).
+        '''
+        rows = self.rows()
+        num_entries = np.diff(self.indptr[self.node_offsets])
+        num_loops = np.bincount(self.graph_index()[rows[rows == self.indices]],
+                minlength=len(self))
+        return (num_entries + num_loops) // 2
+
+    def graph_index(self):
+        ''' Index of the graph that each node belongs to.
+        '''
+        return np.repeat(np.arange(len(self)), self.num_nodes())
+
+    def rows(self):
+        ''' Row (source node) of each entry of indices, i.e. the CSR matrix in COO form.
+        '''
+        return np.repeat(np.arange(len(self.indptr) - 1), np.diff(self.indptr))
+
+    def weights(self, lo=0, hi=None, dtype=np.float32):
+        ''' Weights of the entries lo:hi of indices (all ones for unweighted graphs).
+        '''
+        if hi is None:
+            hi = len(self.indices)
+        if self.edge_weights is None:
+            return np.ones(hi - lo, dtype=dtype)
+        return self.edge_weights[lo:hi].astype(dtype)
+
+    def csr(self, dtype=np.float32):
+        ''' The block-diagonal adjacency matrix of all graphs as a scipy CSR matrix.
+        '''
+        num_nodes = len(self.indptr) - 1
+        return sp.csr_matrix((self.weights(dtype=dtype), self.indices, self.indptr),
+                shape=(num_nodes, num_nodes))
+
+    def adj(self, i, dtype=np.float32):
+        ''' Adjacency matrix of graph i as a scipy CSR matrix indexed from 0.
+        '''
+        lo, hi = self.node_offsets[i], self.node_offsets[i+1]
+        indptr = self.indptr[lo:hi+1]
+        indices = self.indices[indptr[0]:indptr[-1]] - lo
+        return sp.csr_matrix((self.weights(indptr[0], indptr[-1], dtype), indices,
+                indptr - indptr[0]), shape=(hi - lo, hi - lo))
+
+    def subset(self, graph_idx):
+        ''' Select (and reorder) graphs.
+
+        Args:
+            graph_idx: index array or boolean mask over graphs.
+        Returns:
+            A new GraphArrays containing the selected graphs, in the given order.
+        '''
+        graph_idx = np.arange(len(self))[graph_idx]
+        sizes = self.num_nodes()[graph_idx]
+        node_offsets = np.concatenate([[0], np.cumsum(sizes)])
+        # global ids of the selected nodes, in their new order
+        nodes = np.arange(node_offsets[-1]) - np.repeat(node_offsets[:-1], sizes) + \
+                np.repeat(self.node_offsets[graph_idx], sizes)
+        # the same permutation on rows and columns keeps the matrix block diagonal
+        adj = self.csr(dtype=float)[nodes][:, nodes]
+        adj.sort_indices()
+        return GraphArrays(adj.indptr.astype(self.indptr.dtype),
+                adj.indices.astype(self.indices.dtype),
+                node_offsets,
+                self.graph_labels[graph_idx],
+                node_labels=None if self.node_labels is None else self.node_labels[nodes],
+                node_attrs=None if self.node_attrs is None else self.node_attrs[nodes],
+                num_node_labels=self.num_node_labels,
+                edge_weights=None if self.edge_weights is None else adj.data)
+
+
+def _read_array(filename, dtype=np.int64):
+    ''' Parse a comma / whitespace separated text file into a flat array in one pass.
+    '''
+    with open(filename) as f:
+        data = f.read()
+    return np.fromstring(data.replace(',', ' '), dtype=dtype, sep=' ')
+
+def _num_columns(filename):
+    with open(filename) as f:
+        line = f.readline()
+    return len([attr for attr in line.replace(',', ' ').split() if not attr == ''])
+
+def _edges_to_csr(edges, num_nodes):
+    ''' Symmetrize and deduplicate an [num_edges x 2] array of edges, and return the CSR
+    indptr and indices of the adjacency matrix, sorted by (row, col).
+    '''
+    edges = np.asarray(edges, dtype=np.int64).reshape(-1, 2)
+    keys = np.unique(np.concatenate([edges[:, 0] * num_nodes + edges[:, 1],
+                                     edges[:, 1] * num_nodes + edges[:, 0]]))
+    rows = keys // num_nodes
+    indices = (keys % num_nodes).astype(np.int32)
+    indptr = np.concatenate([[0], np.cumsum(np.bincount(rows, minlength=num_nodes))])
+    return indptr, indices
+
+def read_graphfile_arrays(datadir, dataname, max_nodes=None):
     ''' Read data from https://ls11-www.cs.tu-dortmund.de/staff/morris/graphkerneldatasets
         graph index starts with 1 in file
 
+    Each file is parsed with a single vectorized read, and the graphs are split using the node
+    offsets given by the graph indicator.
+
     Returns:
-        List of networkx objects with graph and node labels
+        GraphArrays with the graphs that have at most max_nodes nodes.
     '''
     prefix = os.path.join(datadir, dataname, dataname)
-    filename_graph_indic = prefix + '_graph_indicator.txt'
     # index of graphs that a given node belongs to
-    graph_indic={}
-    with open(filename_graph_indic) as f:
-        i=1
-        for line in f:
-            line=line.strip("\n")
-            graph_indic[i]=int(line)
-            i+=1
-
-    filename_nodes=prefix + '_node_labels.txt'
-    node_labels=[]
+    graph_indic = _read_array(prefix + '_graph_indicator.txt') - 1
+    num_nodes = len(graph_indic)
+
     try:
-        with open(filename_nodes) as f:
-            for line in f:
-                line=line.strip("\n")
-                node_labels+=[int(line) - 1]
-        num_unique_node_labels = max(node_labels) + 1
+        node_labels = _read_array(prefix + '_node_labels.txt') - 1
     except IOError:
         print('No node labels')
- 
-    filename_node_attrs=prefix + '_node_attributes.txt'
-    node_attrs=[]
+        node_labels = None
+
+    filename_node_attrs = prefix + '_node_attributes.txt'
     try:
-        with open(filename_node_attrs) as f:
-            for line in f:
-                line = line.strip("\s\n")
-                attrs = [float(attr) for attr in re.split("[,\s]+", line) if not attr == '']
-                node_attrs.append(np.array(attrs))
+        node_attrs = _read_array(filename_node_attrs, dtype=float).reshape(
+                num_nodes, _num_columns(filename_node_attrs))
     except IOError:
         print('No node attributes')
-       
-    label_has_zero = False
-    filename_graphs=prefix + '_graph_labels.txt'
-    graph_labels=[]
+        node_attrs = None
 
-    # assume that all graph labels appear in the dataset 
+    # assume that all graph labels appear in the dataset
     #(set of labels don't have to be consecutive)
-    label_vals = []
-    with open(filename_graphs) as f:
-        for line in f:
-            line=line.strip("\n")
-            val = int(line)
-            #if val == 0:
-            #    label_has_zero = True
-            if val not in label_vals:
-                label_vals.append(val)
-            graph_labels.append(val)
-    #graph_labels = np.array(graph_labels)
-    label_map_to_int = {val: i for i, val in enumerate(label_vals)}
-    graph_labels = np.array([label_map_to_int[l] for l in graph_labels])
-    #if label_has_zero:
-    #    graph_labels += 1
-    
-    filename_adj=prefix + '_A.txt'
-    adj_list={i:[] for i in range(1,len(graph_labels)+1)}    
-    index_graph={i:[] for i in range(1,len(graph_labels)+1)}
-    num_edges = 0
-    with open(filename_adj) as f:
-        for line in f:
-            line=line.strip("\n").split(",")
-            e0,e1=(int(line[0].strip(" ")),int(line[1].strip(" ")))
-            adj_list[graph_indic[e0]].append((e0,e1))
-            index_graph[graph_indic[e0]]+=[e0,e1]
-            num_edges += 1
-    for k in index_graph.keys():
-        index_graph[k]=[u-1 for u in set(index_graph[k])]
-
-    graphs=[]
-    for i in range(1,1+len(adj_list)):
-        # indexed from 1 here
-        G=nx.from_edgelist(adj_list[i])
-        if max_nodes is not None and G.number_of_nodes() > max_nodes:
-            continue
-      
-        # add features and labels
-        G.graph['label'] = graph_labels[i-1]
-        for u in util.node_iter(G):
-            if len(node_labels) > 0:
-                node_label_one_hot = [0] * num_unique_node_labels
-                node_label = node_labels[u-1]
-                node_label_one_hot[node_label] = 1
-                util.node_dict(G)[u]['label'] = node_label_one_hot
-            if len(node_attrs) > 0:
-                util.node_dict(G)[u]['feat'] = node_attrs[u-1]
-        if len(node_attrs) > 0:
-            G.graph['feat_dim'] = node_attrs[0].shape[0]
-
-        # relabeling
-        mapping={}
-        it=0
-        for n in util.node_iter(G):
-            mapping[n]=it
-            it+=1
-            
-        # indexed from 0
-        graphs.append(nx.relabel_nodes(G, mapping))
+    # labels are mapped to ints in order of first appearance
+    graph_labels = _read_array(prefix + '_graph_labels.txt')
+    label_vals, first_idx, graph_labels = np.unique(graph_labels, return_index=True,
+            return_inverse=True)
+    label_map_to_int = np.empty(len(label_vals), dtype=np.int64)
+    label_map_to_int[np.argsort(first_idx)] = np.arange(len(label_vals))
+    graph_labels = label_map_to_int[graph_labels.reshape(-1)]
+    num_graphs = len(graph_labels)
+
+    # nodes of a graph are usually contiguous; sort them by graph otherwise
+    perm = None
+    if np.any(np.diff(graph_indic) < 0):
+        perm = np.argsort(graph_indic, kind='stable')
+        graph_indic = graph_indic[perm]
+        if node_labels is not None:
+            node_labels = node_labels[perm]
+        if node_attrs is not None:
+            node_attrs = node_attrs[perm]
+    node_offsets = np.concatenate([[0], np.cumsum(np.bincount(graph_indic, minlength=num_graphs))])
+
+    edges = _read_array(prefix + '_A.txt').reshape(-1, 2) - 1
+    if perm is not None:
+        inv_perm = np.empty(num_nodes, dtype=np.int64)
+        inv_perm[perm] = np.arange(num_nodes)
+        edges = inv_perm[edges]
+    indptr, indices = _edges_to_csr(edges, num_nodes)
+
+    data = GraphArrays(indptr, indices, node_offsets, graph_labels,
+            node_labels=node_labels, node_attrs=node_attrs)
+    if max_nodes is not None:
+        keep = data.num_nodes() <= max_nodes
+        if not np.all(keep):
+            data = data.subset(keep)
+    return data
+
+def _iter_lines(f):
+    for line in f:
+        line = line.strip()
+        if not line == '':
+            yield line
+
+def _iter_optional_lines(filename, stack):
+    try:
+        return _iter_lines(stack.enter_context(open(filename)))
+    except IOError:
+        return None
+
+def iter_graphfile(datadir, dataname, max_nodes=None):
+    ''' Stream a dataset in the TU text format one graph at a time.
+
+    All files are walked in lockstep, relying on the node ids of each graph being contiguous in
+    _graph_indicator.txt and on _A.txt listing the edges grouped by graph, so memory use is
+    bounded by the largest graph rather than by the dataset. Graph labels are mapped to ints in
+    order of first appearance, as in read_graphfile_arrays.
+
+    Yields:
+        GraphArrays with a single graph (nodes indexed from 0) for each graph that has at most
+        max_nodes nodes.
+    '''
+    prefix = os.path.join(datadir, dataname, dataname)
+    num_node_labels = None
+    if os.path.isfile(prefix + '_node_labels.txt'):
+        # one cheap pass so that the one-hot dimension matches the whole dataset
+        with open(prefix + '_node_labels.txt') as f:
+            num_node_labels = max(int(line) for line in _iter_lines(f))
+
+    with ExitStack() as stack:
+        graph_indic = _iter_lines(stack.enter_context(open(prefix + '_graph_indicator.txt')))
+        graph_labels = _iter_lines(stack.enter_context(open(prefix + '_graph_labels.txt')))
+        node_labels = _iter_optional_lines(prefix + '_node_labels.txt', stack)
+        node_attrs = _iter_optional_lines(prefix + '_node_attributes.txt', stack)
+        edges = (line.split(',') for line in
+                 _iter_lines(stack.enter_context(open(prefix + '_A.txt'))))
+
+        label_map_to_int = {}
+        next_indic = next(graph_indic, None)
+        next_edge = next(edges, None)
+        node_id = 1
+        for graph_id, line in enumerate(graph_labels, 1):
+            graph_label = label_map_to_int.setdefault(int(line), len(label_map_to_int))
+
+            lo = node_id
+            while next_indic is not None and int(next_indic) == graph_id:
+                node_id += 1
+                next_indic = next(graph_indic, None)
+            if next_indic is not None and int(next_indic) < graph_id:
+                raise ValueError('Nodes in %s_graph_indicator.txt are not grouped by graph '
+                                 '(node %d)' % (prefix, node_id))
+            num_nodes = node_id - lo
+
+            graph_edges = []
+            while next_edge is not None and int(next_edge[0]) < node_id:
+                e0, e1 = int(next_edge[0]), int(next_edge[1])
+                if e0 < lo:
+                    raise ValueError('Edges in %s_A.txt are not grouped by graph' % prefix)
+                if not lo <= e1 < node_id:
+                    raise ValueError('Edge (%d, %d) in %s_A.txt connects different graphs'
+                                     % (e0, e1, prefix))
+                graph_edges.append((e0 - lo, e1 - lo))
+                next_edge = next(edges, None)
+
+            # always consume the node lines to stay in lockstep
+            labels = None
+            if node_labels is not None:
+                labels = np.array([int(next(node_labels)) - 1 for _ in range(num_nodes)],
+                        dtype=np.int64)
+            attrs = None
+            if node_attrs is not None:
+                attrs = np.array([[float(attr) for attr in next(node_attrs).replace(',', ' ').split()]
+                        for _ in range(num_nodes)], dtype=float)
+
+            if max_nodes is not None and num_nodes > max_nodes:
+                continue
+            indptr, indices = _edges_to_csr(graph_edges, num_nodes)
+            yield GraphArrays(indptr, indices, np.array([0, num_nodes]), np.array([graph_label]),
+                    node_labels=labels, node_attrs=attrs, num_node_labels=num_node_labels)
+
+        if next_indic is not None:
+            raise ValueError('%s_graph_indicator.txt has nodes of graph %s, past the last graph '
+                             'of %s_graph_labels.txt' % (prefix, next_indic, prefix))
+        if next_edge is not None:
+            raise ValueError('Edge (%s, %s) in %s_A.txt is past the last graph'
+                             % (next_edge[0], next_edge[1], prefix))
+
+def to_networkx(data):
+    ''' Convert GraphArrays to a list of networkx graphs, in the format returned by
+    read_graphfile: graph attribute 'label' ('feat_dim' if there are node attributes), node
+    attributes 'label' (one-hot list) and 'feat'. Nodes are indexed from 0 within each graph.
+    '''
+    graphs = []
+    node_offsets = data.node_offsets
+    for i in range(len(data)):
+        lo, hi = node_offsets[i], node_offsets[i+1]
+        G = nx.Graph(label=data.graph_labels[i])
+        node_attr_dicts = [{} for _ in range(hi - lo)]
+        if data.node_labels is not None:
+            one_hot = np.zeros((hi - lo, data.num_node_labels), dtype=int)
+            one_hot[np.arange(hi - lo), data.node_labels[lo:hi]] = 1
+            for u, node_label_one_hot in enumerate(one_hot.tolist()):
+                node_attr_dicts[u]['label'] = node_label_one_hot
+        if data.node_attrs is not None:
+            for u in range(hi - lo):
+                node_attr_dicts[u]['feat'] = data.node_attrs[lo + u]
+            G.graph['feat_dim'] = data.node_attrs.shape[1]
+        G.add_nodes_from(enumerate(node_attr_dicts))
+        adj = data.adj(i, dtype=float).tocoo()
+        if data.edge_weights is None:
+            G.add_edges_from(zip(adj.row.tolist(), adj.col.tolist()))
+        else:
+            G.add_weighted_edges_from(zip(adj.row.tolist(), adj.col.tolist(), adj.data.tolist()))
+        graphs.append(G)
     return graphs
 
+def read_graphfile(datadir, dataname, max_nodes=None):
+    ''' Read data from https://ls11-www.cs.tu-dortmund.de/staff/morris/graphkerneldatasets
+        graph index starts with 1 in file
+
+    Returns:
+        List of networkx objects with graph and node labels
+    '''
+    return to_networkx(read_graphfile_arrays(datadir, dataname, max_nodes=max_nodes))
+
+def from_networkx(graphs, labels=None):
+    ''' Convert a list of networkx graphs to GraphArrays. Nodes are numbered in the order of
+    G.nodes(). Node features are taken from the 'feat' attribute, node labels from the (one-hot)
+    'label' attribute, and edge weights from the 'weight' attribute when any edge has one.
+
+    Args:
+        labels: graph labels. Defaults to the 'label' graph attribute.
+    '''
+    sizes = np.array([G.number_of_nodes() for G in graphs], dtype=np.int64)
+    node_offsets = np.concatenate([[0], np.cumsum(sizes)])
+    if labels is None:
+        labels = [G.graph['label'] for G in graphs]
+    weighted = any('weight' in d for G in graphs for _, _, d in G.edges(data=True))
+
+    rows, cols, weights = [], [], []
+    node_labels, node_attrs = [], []
+    for G, offset in zip(graphs, node_offsets):
+        mapping = {u: i + offset for i, u in enumerate(G.nodes())}
+        for u, v, w in G.edges(data='weight', default=1.0):
+            rows.append(mapping[u])
+            cols.append(mapping[v])
+            weights.append(w)
+        for u, d in G.nodes(data=True):
+            if 'label' in d:
+                node_labels.append(int(np.argmax(d['label'])))
+            if 'feat' in d:
+                node_attrs.append(np.asarray(d['feat'], dtype=float))
+
+    num_nodes = int(node_offsets[-1])
+    rows = np.array(rows, dtype=np.int64)
+    cols = np.array(cols, dtype=np.int64)
+    weights = np.array(weights, dtype=float)
+    loops = rows == cols
+    adj = sp.csr_matrix((np.concatenate([weights, weights[~loops]]),
+                         (np.concatenate([rows, cols[~loops]]),
+                          np.concatenate([cols, rows[~loops]]))),
+                        shape=(num_nodes, num_nodes))
+    adj.sum_duplicates()
+
+    num_node_labels = None
+    if num_nodes > 0 and len(node_labels) == num_nodes:
+        num_node_labels = len(next(d['label'] for G in graphs for _, d in G.nodes(data=True)))
+        node_labels = np.array(node_labels, dtype=np.int64)
+    else:
+        node_labels = None
+    if num_nodes > 0 and len(node_attrs) == num_nodes:
+        node_attrs = np.vstack(node_attrs)
+    else:
+        node_attrs = None
+    return GraphArrays(adj.indptr.astype(np.int64), adj.indices.astype(np.int32), node_offsets,
+            np.asarray(labels), node_labels=node_labels, node_attrs=node_attrs,
+            num_node_labels=num_node_labels, edge_weights=adj.data if weighted else None)
+
+# ---- Binary dataset format
+# A dataset is a directory with one .npy file per array of GraphArrays, so that it can be
+# memory-mapped when loaded.
+_ARRAY_FIELDS = ['indptr', 'indices', 'node_offsets', 'graph_labels', 'node_labels',
+                 'node_attrs', 'edge_weights']
+
+class _NpyWriter(object):
+    ''' Append arrays to a raw file and turn it into a .npy file once the final shape is known.
+    '''
+    def __init__(self, filename, dtype):
+        self.filename = filename
+        self.dtype = np.dtype(dtype)
+        self.raw = None
+        self.length = 0
+        self.trailing_shape = ()
+
+    def append(self, arr):
+        arr = np.ascontiguousarray(arr, dtype=self.dtype)
+        if self.raw is None:
+            self.raw = open(self.filename + '.raw', 'wb')
+            self.trailing_shape = arr.shape[1:]
+        self.raw.write(arr.tobytes())
+        self.length += arr.shape[0]
+
+    def close(self):
+        if self.raw is None:
+            return
+        self.raw.close()
+        header = {'descr': np.lib.format.dtype_to_descr(self.dtype), 'fortran_order': False,
+                  'shape': (self.length,) + self.trailing_shape}
+        with open(self.filename, 'wb') as f, open(self.filename + '.raw', 'rb') as raw:
+            np.lib.format.write_array_header_1_0(f, header)
+            shutil.copyfileobj(raw, f)
+        os.remove(self.filename + '.raw')
+
+def save_graph_stream(graphs, path):
+    ''' Save an iterable of GraphArrays as a single dataset in the binary format, appending one
+    chunk at a time so that memory use does not grow with the dataset. The directory is written
+    to a temporary location first and then renamed, so that an interrupted conversion never
+    leaves a partial dataset behind.
+
+    Returns:
+        Number of graphs written.
+    '''
+    tmp_path = path + '.tmp%d' % os.getpid()
+    os.makedirs(tmp_path)
+    dtypes = {'indptr': np.int64, 'indices': np.int32, 'node_offsets': np.int64,
+              'graph_labels': np.int64, 'node_labels': np.int64, 'node_attrs': float,
+              'edge_weights': float}
+    writers = {name: _NpyWriter(os.path.join(tmp_path, name + '.npy'), dtypes[name])
+               for name in _ARRAY_FIELDS}
+    writers['indptr'].append(np.zeros(1))
+    writers['node_offsets'].append(np.zeros(1))
+    num_graphs = 0
+    num_nodes = 0
+    num_entries = 0
+    num_node_labels = None
+    for data in graphs:
+        writers['indptr'].append(data.indptr[1:] + num_entries)
+        writers['indices'].append(data.indices + num_nodes)
+        writers['node_offsets'].append(data.node_offsets[1:] + num_nodes)
+        writers['graph_labels'].append(data.graph_labels)
+        for name in ['node_labels', 'node_attrs', 'edge_weights']:
+            if getattr(data, name) is not None:
+                writers[name].append(getattr(data, name))
+        if data.num_node_labels is not None:
+            num_node_labels = max(num_node_labels or 0, data.num_node_labels)
+        num_graphs += len(data)
+        num_nodes += int(data.node_offsets[-1])
+        num_entries += int(data.indptr[-1])
+    if writers['indices'].raw is None:
+        writers['indices'].append(np.zeros(0))
+        writers['graph_labels'].append(np.zeros(0))
+    for writer in writers.values():
+        writer.close()
+    if num_node_labels is not None:
+        np.save(os.path.join(tmp_path, 'num_node_labels.npy'), np.array(num_node_labels))
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    os.rename(tmp_path, path)
+    return num_graphs
+
+def save_graph_arrays(data, path):
+    ''' Save GraphArrays in the binary format (see save_graph_stream).
+    '''
+    save_graph_stream([data], path)
+
+def load_graph_arrays(path, mmap_mode=None):
+    ''' Load GraphArrays saved by save_graph_arrays.
+
+    Args:
+        mmap_mode: passed to np.load; use 'r' to memory-map the arrays instead of reading them.
+    '''
+    arrays = {}
+    for name in _ARRAY_FIELDS + ['num_node_labels']:
+        filename = os.path.join(path, name + '.npy')
+        arrays[name] = np.load(filename, mmap_mode=mmap_mode) if os.path.isfile(filename) else None
+    if arrays['num_node_labels'] is not None:
+        arrays['num_node_labels'] = int(arrays['num_node_labels'])
+    return GraphArrays(**arrays)
+
+def fingerprint(filenames):
+    ''' Fingerprint of a set of source files from their names, sizes and modification times.
+    '''
+    h = hashlib.sha1()
+    for filename in sorted(filenames):
+        st = os.stat(filename)
+        h.update(('%s:%d:%d;' % (os.path.basename(filename), st.st_size, st.st_mtime_ns)).encode())
+    return h.hexdigest()[:16]
+
+def convert_graphfile(datadir, dataname, path, max_nodes=None, stream=False):
+    ''' Convert a dataset from the TU text format to the binary format.
+
+    Args:
+        stream: convert one graph at a time with iter_graphfile, for datasets larger than
+            memory. The converted dataset is then loaded memory-mapped.
+    '''
+    if stream:
+        save_graph_stream(iter_graphfile(datadir, dataname, max_nodes=max_nodes), path)
+        return load_graph_arrays(path, mmap_mode='r')
+    data = read_graphfile_arrays(datadir, dataname, max_nodes=max_nodes)
+    save_graph_arrays(data, path)
+    return data
+
+def convert_pkl(pkl_fname, path):
+    ''' Convert a pickled [graphs, labels, test_graphs, test_labels] list of networkx graphs to
+    the binary format. The training and test graphs are saved under path/train and path/test.
+    '''
+    with open(pkl_fname, 'rb') as pkl_file:
+        graphs, labels, test_graphs, test_labels = pickle.load(pkl_file)
+    os.makedirs(path, exist_ok=True)
+    train_data = from_networkx(graphs, labels)
+    test_data = from_networkx(test_graphs, test_labels)
+    save_graph_arrays(train_data, os.path.join(path, 'train'))
+    save_graph_arrays(test_data, os.path.join(path, 'test'))
+    return train_data, test_data
+
+def load_graphfile_cached(datadir, dataname, max_nodes=None, cache_dir=None):
+    ''' Read a TU dataset, reusing a binary copy of it when the source files are unchanged.
+
+    The full dataset is cached under cache_dir (default: datadir/cache), keyed by the
+    fingerprint of the source files; max_nodes is applied after loading. The key of the returned
+    GraphArrays is derived from the fingerprint and max_nodes.
+
+    Returns:
+        GraphArrays
+    '''
+    prefix = os.path.join(datadir, dataname, dataname)
+    sources = [prefix + suffix for suffix in ['_graph_indicator.txt', '_node_labels.txt',
+            '_node_attributes.txt', '_graph_labels.txt', '_A.txt'] if os.path.isfile(prefix + suffix)]
+    if cache_dir is None:
+        cache_dir = os.path.join(datadir, 'cache')
+    os.makedirs(cache_dir, exist_ok=True)
+    key = dataname + '_' + fingerprint(sources)
+    cache_path = os.path.join(cache_dir, key)
+    if os.path.isdir(cache_path):
+        data = load_graph_arrays(cache_path)
+    else:
+        data = convert_graphfile(datadir, dataname, cache_path)
+        print('Saved converted dataset: ', cache_path)
+    if max_nodes is not None:
+        keep = data.num_nodes() <= max_nodes
+        if not np.all(keep):
+            data = data.subset(keep)
+            key += '_max%d' % max_nodes
+    data.key = key
+    return data
+
+def load_pkl_cached(pkl_fname, cache_dir=None):
+    ''' Read a pickled list of networkx graphs (see convert_pkl), reusing a binary copy of it
+    when the pickle is unchanged.
+
+    Returns:
+        GraphArrays of the training graphs and of the test graphs
+    '''
+    if cache_dir is None:
+        cache_dir = os.path.join(os.path.dirname(pkl_fname), 'cache')
+    name = os.path.splitext(os.path.basename(pkl_fname))[0]
+    cache_path = os.path.join(cache_dir, name + '_' + fingerprint([pkl_fname]))
+    if os.path.isdir(cache_path):
+        return (load_graph_arrays(os.path.join(cache_path, 'train')),
+                load_graph_arrays(os.path.join(cache_path, 'test')))
+    os.makedirs(cache_dir, exist_ok=True)
+    data = convert_pkl(pkl_fname, cache_path + '.tmp%d' % os.getpid())
+    os.rename(cache_path + '.tmp%d' % os.getpid(), cache_path)
+    print('Saved converted dataset: ', cache_path)
+    return data
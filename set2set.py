@@ -6,7 +6,7 @@ import torch.nn.functional as F
 import numpy as np
 
 class Set2Set(nn.Module):
-    def __init__(self, input_dim, hidden_dim, act_fn=nn.ReLU, num_layers=1):
+    def __init__(self, input_dim, hidden_dim, act_fn=nn.ReLU, num_layers=1, processing_steps=None):
         '''
         Args:
             input_dim: input dim of Set2Set. 
@@ -14,11 +14,14 @@ class Set2Set(nn.Module):
                 the LSTM in Set2Set. 
                 This is a concatenation of weighted sum of embedding (dim input_dim), and the LSTM
                 hidden/output (dim: self.lstm_output_dim).
+            processing_steps: number of attention steps. If None, one step per node of the
+                (padded) input, as in earlier versions.
         '''
         super(Set2Set, self).__init__()
         self.input_dim = input_dim
         self.hidden_dim = hidden_dim
         self.num_layers = num_layers
+        self.processing_steps = processing_steps
         if hidden_dim <= input_dim:
             print('ERROR: Set2Set output_dim should be larger than input_dim')
         # the hidden is a concatenation of weighted sum of embedding and LSTM output
@@ -29,29 +32,64 @@ class Set2Set(nn.Module):
         self.pred = nn.Linear(hidden_dim, input_dim)
         self.act = act_fn()
 
-    def forward(self, embedding):
+    # torch.compile does not capture LSTMs: the readout runs eagerly between compiled graphs
+    @torch.compiler.disable
+    def forward(self, embedding, mask=None, batch=None, num_graphs=None):
         '''
         Args:
-            embedding: [batch_size x n x d] embedding matrix
+            embedding: [batch_size x n x d] embedding matrix, or [num_nodes x d] embeddings of
+                packed graphs
+            mask: [batch_size x n x 1] mask of the real nodes of a padded embedding matrix.
+                Padded nodes get no attention.
+            batch: [num_nodes] index of the graph of each node of packed graphs.
+            num_graphs: number of packed graphs.
         Returns:
             aggregated: [batch_size x d] vector representation of all embeddings
         '''
-        batch_size = embedding.size()[0]
-        n = embedding.size()[1]
+        if batch is not None:
+            batch_size = num_graphs
+            n = self.processing_steps
+            if n is None:
+                n = int(torch.bincount(batch, minlength=num_graphs).max())
+        else:
+            batch_size = embedding.size()[0]
+            n = embedding.size()[1] if self.processing_steps is None else self.processing_steps
 
-        hidden = (torch.zeros(self.num_layers, batch_size, self.lstm_output_dim).cuda(),
-                  torch.zeros(self.num_layers, batch_size, self.lstm_output_dim).cuda())
+        hidden = (embedding.new_zeros(self.num_layers, batch_size, self.lstm_output_dim),
+                  embedding.new_zeros(self.num_layers, batch_size, self.lstm_output_dim))
 
-        q_star = torch.zeros(batch_size, 1, self.hidden_dim).cuda()
+        q_star = embedding.new_zeros(batch_size, 1, self.hidden_dim)
         for i in range(n):
             # q: batch_size x 1 x input_dim
             q, hidden = self.lstm(q_star, hidden)
-            # e: batch_size x n x 1
-            e = embedding @ torch.transpose(q, 1, 2)
-            a = nn.Softmax(dim=1)(e)
-            r = torch.sum(a * embedding, dim=1, keepdim=True)
+            if batch is not None:
+                r = self.segment_attention(embedding, q, batch, batch_size)
+            else:
+                # e: batch_size x n x 1
+                e = (embedding @ torch.transpose(q, 1, 2)).float()
+                if mask is not None:
+                    e = e.masked_fill(mask == 0, float('-inf'))
+                a = nn.Softmax(dim=1)(e)
+                r = torch.sum(a * embedding, dim=1, keepdim=True)
             q_star = torch.cat((q, r), dim=2)
         q_star = torch.squeeze(q_star, dim=1)
         out = self.act(self.pred(q_star))
 
         return out
+
+    def segment_attention(self, embedding, q, batch, batch_size):
+        ''' Attention readout r of packed graphs: softmax of the scores of the nodes of each
+        graph, and weighted sum of their embeddings.
+        Returns:
+            r: batch_size x 1 x input_dim
+        '''
+        # e: num_nodes
+        e = torch.sum(embedding * q[batch, 0], dim=1).float()
+        # the softmax does not depend on the shift by the max
+        e_max = e.detach().new_zeros(batch_size).scatter_reduce(0, batch, e.detach(),
+                reduce='amax', include_self=False)
+        e = torch.exp(e - e_max[batch])
+        a = e / e.new_zeros(batch_size).index_add_(0, batch, e)[batch]
+        r = e.new_zeros(batch_size, embedding.size(1)).index_add_(0, batch,
+                a.unsqueeze(1) * embedding)
+        return r.unsqueeze(1)
@@ -0,0 +1,50 @@
+import torch
+
+import encoders
+
+
+def pad(x, num_nodes):
+    ''' Pad the node dimensions (all but the first and last of features) of a batch.
+    '''
+    if x.dim() == 3 and x.size(1) == x.size(2):
+        out = x.new_zeros(x.size(0), num_nodes, num_nodes)
+        out[:, :x.size(1), :x.size(2)] = x
+    else:
+        out = x.new_zeros(x.size(0), num_nodes, x.size(2))
+        out[:, :x.size(1)] = x
+    return out
+
+def random_graph(num_nodes, input_dim):
+    x = torch.rand(1, num_nodes, input_dim)
+    adj = (torch.rand(1, num_nodes, num_nodes) > 0.5).float()
+    adj = ((adj + adj.transpose(1, 2)) > 0).float()
+    return x, adj
+
+def test_soft_pooling_padding_invariance():
+    torch.manual_seed(0)
+    model = encoders.SoftPoolingGcnEncoder(20, 3, 8, 8, 2, 3, 8, num_pooling=1, linkpred=False)
+    # nonzero biases, so that padding rows are not zero after the conv layers
+    for m in model.modules():
+        if isinstance(m, encoders.GraphConv) and m.bias is not None:
+            m.bias.data.fill_(0.5)
+    model.eval()
+    x, adj = random_graph(6, 3)
+    with torch.no_grad():
+        ypred = [model(pad(x, n), pad(adj, n), [6]) for n in [6, 20]]
+    assert torch.allclose(ypred[0], ypred[1], atol=1e-6)
+
+def test_masked_batch_norm_single_real_node():
+    mask = torch.tensor([[[1.], [0.], [0.]], [[0.], [0.], [0.]]])
+    x = torch.rand(2, 3, 4)
+    for compiled_path in [False, True]:
+        bn = encoders.MaskedBatchNorm(4)
+        bn.train()
+        if compiled_path:
+            y = bn._masked_batch_norm(x.reshape(-1, 4), mask.reshape(-1, 1)).view_as(x)
+        else:
+            y = bn(x, mask)
+        assert torch.all(torch.isfinite(y))
+        assert torch.all(y * (1 - mask) == 0)
+        # no statistics from a single node
+        assert torch.equal(bn.running_mean, torch.zeros(4))
+        assert torch.equal(bn.running_var, torch.ones(4))
@@ -0,0 +1,61 @@
+import networkx as nx
+import numpy as np
+import pytest
+
+import argparse
+
+import load_data
+from graph_sampler import GraphSampler, add_dataset_features
+
+
+def make_graph(num_nodes, feat_dim=3):
+    G = nx.path_graph(num_nodes)
+    G.graph['label'] = 0
+    for u in G.nodes():
+        G.nodes[u]['feat'] = np.full(feat_dim, u + 1.0)
+    return G
+
+def test_collate_reused_buffers_variable_batch_sizes():
+    # graphs of 4 and of 8 nodes, padded to the largest graph of each batch: a large batch,
+    # then a small and a medium one at another padding
+    graphs = [make_graph(4) for _ in range(8)] + [make_graph(8) for _ in range(8)]
+    dataset = GraphSampler(graphs, normalize=False)
+    dataset.pad_to_batch_max = True
+    dataset.num_buffers = 1
+    for indices in [range(8), range(8, 10), range(8, 14), range(4), range(5)]:
+        batch = [dataset[i] for i in indices]
+        data = dataset.collate(batch)
+        num_nodes = max(graphs[i].number_of_nodes() for i in indices)
+        assert data['adj'].shape == (len(batch), num_nodes, num_nodes)
+        assert data['feats'].shape == (len(batch), num_nodes, 3)
+        for j, i in enumerate(indices):
+            n = graphs[i].number_of_nodes()
+            adj = np.zeros((num_nodes, num_nodes), dtype=np.float32)
+            adj[:n, :n] = nx.to_numpy_array(graphs[i])
+            assert np.array_equal(data['adj'][j].numpy(), adj)
+            assert np.all(data['feats'][j, n:].numpy() == 0)
+
+def label_feature_graphs(data):
+    graphs = load_data.to_networkx(data)
+    for G in graphs:
+        for u in G.nodes():
+            G.nodes[u]['feat'] = np.array(G.nodes[u]['label'])
+    return graphs
+
+@pytest.mark.parametrize('features', ['deg', 'struct'])
+def test_dataset_features_match_per_split_features(tmp_path, features):
+    data = load_data.load_graphfile_cached('data', 'ENZYMES', max_nodes=20,
+            cache_dir=str(tmp_path))
+    args = argparse.Namespace(feature_type=features, cache=True, cache_dir=str(tmp_path),
+            datadir='data')
+    graphs = label_feature_graphs(data)
+    # computed over the whole dataset (and then read from the cache)
+    for _ in range(2):
+        add_dataset_features(graphs, data, args)
+        split = graphs[::3]
+        dataset = GraphSampler(split, normalize=False, features=features)
+        # computed over the graphs of the split
+        expected = GraphSampler(label_feature_graphs(data)[::3], normalize=False,
+                features=features)
+        assert dataset.feat_dim == expected.feat_dim
+        np.testing.assert_allclose(dataset.feature_data, expected.feature_data)
@@ -0,0 +1,44 @@
+import numpy as np
+import pytest
+
+import os
+
+import load_data
+
+
+def write_dataset(datadir, dataname, graph_indicator, graph_labels, edges):
+    os.makedirs(os.path.join(datadir, dataname))
+    prefix = os.path.join(datadir, dataname, dataname)
+    with open(prefix + '_graph_indicator.txt', 'w') as f:
+        f.write(''.join('%d\n' % graph_id for graph_id in graph_indicator))
+    with open(prefix + '_graph_labels.txt', 'w') as f:
+        f.write(''.join('%d\n' % label for label in graph_labels))
+    with open(prefix + '_A.txt', 'w') as f:
+        f.write(''.join('%d, %d\n' % edge for edge in edges))
+
+def test_iter_graphfile_matches_read_graphfile_arrays(tmp_path):
+    write_dataset(str(tmp_path), 'G', [1, 1, 1, 2, 2], [3, 5],
+            [(1, 2), (2, 1), (2, 3), (3, 2), (4, 5), (5, 4)])
+    data = load_data.read_graphfile_arrays(str(tmp_path), 'G')
+    graphs = list(load_data.iter_graphfile(str(tmp_path), 'G'))
+    assert len(graphs) == len(data)
+    for i, G in enumerate(graphs):
+        assert G.graph_labels[0] == data.graph_labels[i]
+        assert (G.adj(0) != data.adj(i)).nnz == 0
+
+@pytest.mark.parametrize('graph_indicator, graph_labels, edges', [
+    # edge from graph 1 to graph 2
+    ([1, 1, 2, 2], [0, 1], [(1, 3), (3, 1)]),
+    # edge to a node before the graph
+    ([1, 1, 2, 2], [0, 1], [(1, 2), (2, 1), (3, 1)]),
+    # nodes not grouped by graph
+    ([1, 2, 1, 2], [0, 1], [(1, 3), (3, 1)]),
+    # nodes of a graph without a label
+    ([1, 1, 2, 2, 3], [0, 1], [(1, 2), (2, 1)]),
+    # edge past the last node
+    ([1, 1, 2, 2], [0, 1], [(1, 2), (2, 1), (5, 6)]),
+])
+def test_iter_graphfile_malformed(tmp_path, graph_indicator, graph_labels, edges):
+    write_dataset(str(tmp_path), 'G', graph_indicator, graph_labels, edges)
+    with pytest.raises(ValueError):
+        list(load_data.iter_graphfile(str(tmp_path), 'G'))
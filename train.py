@@ -8,11 +8,11 @@ import numpy as np
 import sklearn.metrics as metrics
 import torch
 import torch.nn as nn
-from torch.autograd import Variable
 import tensorboardX
 from tensorboardX import SummaryWriter
 
 import argparse
+import functools
 import os
 import pickle
 import random
@@ -23,7 +23,7 @@ import cross_val
 import encoders
 import gen.feat as featgen
 import gen.data as datagen
-from graph_sampler import GraphSampler
+from graph_sampler import PrefetchLoader, add_dataset_features, build_loader, build_sampler
 import load_data
 import util
 
@@ -33,19 +33,27 @@ def evaluate(dataset, model, args, name='Validation', max_num_examples=None):
 
     labels = []
     preds = []
-    for batch_idx, data in enumerate(dataset):
-        adj = Variable(data['adj'].float(), requires_grad=False).cuda()
-        h0 = Variable(data['feats'].float()).cuda()
-        labels.append(data['label'].long().numpy())
-        batch_num_nodes = data['num_nodes'].int().numpy()
-        assign_input = Variable(data['assign_feats'].float(), requires_grad=False).cuda()
-
-        ypred = model(h0, adj, batch_num_nodes, assign_x=assign_input)
+    num_examples = 0
+    for batch_idx, data in enumerate(prefetch(dataset, args)):
+        adj = data['adj']
+        h0 = data['feats']
+        labels.append(data['label'].cpu().numpy())
+        batch_num_nodes = data['num_nodes']
+        assign_input = data['assign_feats']
+        batch = data.get('batch')
+
+        # no autograd graph, and no version counters on the tensors. A compiled model runs
+        # under no_grad instead: under inference_mode, the guards of the tensor it makes of
+        # batch_num_nodes fail and its forward pass falls back to eager execution
+        grad_mode = torch.no_grad() if args.compile else torch.inference_mode()
+        with grad_mode, autocast(args):
+            ypred = model(h0, adj, batch_num_nodes, assign_x=assign_input, batch=batch)
         _, indices = torch.max(ypred, 1)
         preds.append(indices.cpu().data.numpy())
 
+        num_examples += len(batch_num_nodes)
         if max_num_examples is not None:
-            if (batch_idx+1)*args.batch_size > max_num_examples:
+            if num_examples > max_num_examples:
                 break
 
     labels = np.hstack(labels)
@@ -58,6 +66,30 @@ def evaluate(dataset, model, args, name='Validation', max_num_examples=None):
     print(name, " accuracy:", result['acc'])
     return result
 
+def prepare_batch(data, args):
+    ''' A batch of the DataLoader as the model takes it: tensors converted and on args.device
+    (pinned first when copied to a GPU, so that the copy is asynchronous), and num_nodes as a
+    numpy array.
+    '''
+    def to_device(tensor):
+        if args.device.type == 'cuda':
+            return tensor.pin_memory().to(args.device, non_blocking=True)
+        return tensor.to(args.device)
+    prepared = {'adj': to_device(data['adj'].float()), 'feats': to_device(data['feats']),
+                'assign_feats': to_device(data['assign_feats']),
+                'label': to_device(data['label'].long()),
+                'num_nodes': data['num_nodes'].int().numpy()}
+    if 'batch' in data:
+        prepared['batch'] = to_device(data['batch'])
+    return prepared
+
+def prefetch(dataset, args):
+    ''' The batches of DataLoader dataset prepared by prepare_batch, --prefetch batches ahead
+    of the model by a background thread.
+    '''
+    return PrefetchLoader(dataset, functools.partial(prepare_batch, args=args),
+                          depth=args.prefetch)
+
 def gen_prefix(args):
     if args.bmname is not None:
         name = args.bmname
@@ -106,7 +138,10 @@ def log_graph(adj, batch_num_nodes, writer, epoch, batch_idx, assign_tensor=None
     for i in range(len(batch_idx)):
         ax = plt.subplot(2, 2, i+1)
         num_nodes = batch_num_nodes[batch_idx[i]]
-        adj_matrix = adj[batch_idx[i], :num_nodes, :num_nodes].cpu().data.numpy()
+        adj_matrix = adj[batch_idx[i]]
+        if adj_matrix.layout != torch.strided:
+            adj_matrix = adj_matrix.to_dense()
+        adj_matrix = adj_matrix[:num_nodes, :num_nodes].cpu().data.numpy()
         G = nx.from_numpy_matrix(adj_matrix)
         nx.draw(G, pos=nx.spring_layout(G), with_labels=True, node_color='#336699',
                 edge_color='grey', width=0.5, node_size=300,
@@ -149,7 +184,10 @@ def log_graph(adj, batch_num_nodes, writer, epoch, batch_idx, assign_tensor=None
     for i in range(len(batch_idx)):
         ax = plt.subplot(2, 2, i+1)
         num_nodes = batch_num_nodes[batch_idx[i]]
-        adj_matrix = adj[batch_idx[i], :num_nodes, :num_nodes].cpu().data.numpy()
+        adj_matrix = adj[batch_idx[i]]
+        if adj_matrix.layout != torch.strided:
+            adj_matrix = adj_matrix.to_dense()
+        adj_matrix = adj_matrix[:num_nodes, :num_nodes].cpu().data.numpy()
 
         label = np.argmax(assignment[batch_idx[i]], axis=1).astype(int)
         label = label[: batch_num_nodes[batch_idx[i]]]
@@ -173,6 +211,7 @@ def log_graph(adj, batch_num_nodes, writer, epoch, batch_idx, assign_tensor=None
 def train(dataset, model, args, same_feat=True, val_dataset=None, test_dataset=None, writer=None,
         mask_nodes = True):
     writer_batch_idx = [0, 3, 6, 9]
+    compile_model(model, args)
     
     optimizer = torch.optim.Adam(filter(lambda p : p.requires_grad, model.parameters()), lr=0.001)
     iter = 0
@@ -191,37 +230,47 @@ def train(dataset, model, args, same_feat=True, val_dataset=None, test_dataset=N
     test_accs = []
     test_epochs = []
     val_accs = []
+    val_epochs = []
+    # time of the end of the last evaluation, see --eval-time
+    eval_end_time = time.time()
+    # batch whose assignments are logged; computed once, as the length of bucketed batches
+    # (BucketBatchSampler) is that of a whole epoch of batches drawn again
+    log_batch_idx = len(dataset) // 2
     for epoch in range(args.num_epochs):
         total_time = 0
         avg_loss = 0.0
         model.train()
         print('Epoch: ', epoch)
-        for batch_idx, data in enumerate(dataset):
+        loader = prefetch(dataset, args)
+        for batch_idx, data in enumerate(loader):
             begin_time = time.time()
             model.zero_grad()
-            adj = Variable(data['adj'].float(), requires_grad=False).cuda()
-            h0 = Variable(data['feats'].float(), requires_grad=False).cuda()
-            label = Variable(data['label'].long()).cuda()
-            batch_num_nodes = data['num_nodes'].int().numpy() if mask_nodes else None
-            assign_input = Variable(data['assign_feats'].float(), requires_grad=False).cuda()
-
-            ypred = model(h0, adj, batch_num_nodes, assign_x=assign_input)
-            if not args.method == 'soft-assign' or not args.linkpred:
-                loss = model.loss(ypred, label)
-            else:
-                loss = model.loss(ypred, label, adj, batch_num_nodes)
+            adj = data['adj']
+            h0 = data['feats']
+            label = data['label']
+            batch_num_nodes = data['num_nodes'] if mask_nodes else None
+            assign_input = data['assign_feats']
+            batch = data.get('batch')
+
+            with autocast(args):
+                ypred = model(h0, adj, batch_num_nodes, assign_x=assign_input, batch=batch)
+                if not args.method == 'soft-assign' or not args.linkpred:
+                    loss = model.loss(ypred, label)
+                else:
+                    loss = model.loss(ypred, label, adj, batch_num_nodes)
             loss.backward()
             nn.utils.clip_grad_norm_(model.parameters(), args.clip)
             optimizer.step()
             iter += 1
-            avg_loss += loss
+            # a float: the loss tensor would keep the graph of the batch alive
+            avg_loss += loss.item()
             #if iter % 20 == 0:
             #    print('Iter: ', iter, ', loss: ', loss.data[0])
             elapsed = time.time() - begin_time
             total_time += elapsed
 
             # log once per XX epochs
-            if epoch % 10 == 0 and batch_idx == len(dataset) // 2 and args.method == 'soft-assign' and writer is not None:
+            if epoch % 10 == 0 and batch_idx == log_batch_idx and args.method == 'soft-assign' and writer is not None:
                 log_assignment(model.assign_tensor, writer, epoch, writer_batch_idx)
                 if args.log_graph:
                     log_graph(adj, batch_num_nodes, writer, epoch, writer_batch_idx, model.assign_tensor)
@@ -230,13 +279,23 @@ def train(dataset, model, args, same_feat=True, val_dataset=None, test_dataset=N
             writer.add_scalar('loss/avg_loss', avg_loss, epoch)
             if args.linkpred:
                 writer.add_scalar('loss/linkpred_loss', model.link_loss, epoch)
-        print('Avg loss: ', avg_loss, '; epoch time: ', total_time)
+        print('Avg loss: ', avg_loss, '; epoch time: ', total_time, '; input stall: ',
+              loader.stall_time)
+        if writer is not None:
+            writer.add_scalar('time/input_stall', loader.stall_time, epoch)
+        if args.eval_time is not None:
+            evaluate_epoch = time.time() - eval_end_time >= args.eval_time
+        else:
+            evaluate_epoch = (epoch + 1) % args.eval_every == 0
+        if not evaluate_epoch and epoch < args.num_epochs - 1:
+            continue
         result = evaluate(dataset, model, args, name='Train', max_num_examples=100)
         train_accs.append(result['acc'])
         train_epochs.append(epoch)
         if val_dataset is not None:
             val_result = evaluate(val_dataset, model, args, name='Validation')
             val_accs.append(val_result['acc'])
+            val_epochs.append(epoch)
         if val_result['acc'] > best_val_result['acc'] - 1e-7:
             best_val_result['acc'] = val_result['acc']
             best_val_result['epoch'] = epoch
@@ -258,6 +317,10 @@ def train(dataset, model, args, same_feat=True, val_dataset=None, test_dataset=N
             print('Test result: ', test_result)
             test_epochs.append(test_result['epoch'])
             test_accs.append(test_result['acc'])
+        eval_end_time = time.time()
+        if args.patience is not None and epoch - best_val_result['epoch'] >= args.patience:
+            print('No validation improvement in ', args.patience, ' epochs: early stopping')
+            break
 
     matplotlib.style.use('seaborn')
     plt.switch_backend('agg')
@@ -273,7 +336,7 @@ def train(dataset, model, args, same_feat=True, val_dataset=None, test_dataset=N
     plt.close()
     matplotlib.style.use('default')
 
-    return model, val_accs
+    return model, val_accs, val_epochs
 
 def prepare_data(graphs, args, test_graphs=None, max_nodes=0):
 
@@ -300,29 +363,16 @@ def prepare_data(graphs, args, test_graphs=None, max_nodes=0):
             "{0:.2f}".format(np.std([G.number_of_nodes() for G in graphs])))
 
     # minibatch
-    dataset_sampler = GraphSampler(train_graphs, normalize=False, max_num_nodes=max_nodes,
-            features=args.feature_type)
-    train_dataset_loader = torch.utils.data.DataLoader(
-            dataset_sampler, 
-            batch_size=args.batch_size, 
-            shuffle=True,
-            num_workers=args.num_workers)
-
-    dataset_sampler = GraphSampler(val_graphs, normalize=False, max_num_nodes=max_nodes,
-            features=args.feature_type)
-    val_dataset_loader = torch.utils.data.DataLoader(
-            dataset_sampler, 
-            batch_size=args.batch_size, 
-            shuffle=False,
-            num_workers=args.num_workers)
-
-    dataset_sampler = GraphSampler(test_graphs, normalize=False, max_num_nodes=max_nodes,
-            features=args.feature_type)
-    test_dataset_loader = torch.utils.data.DataLoader(
-            dataset_sampler, 
-            batch_size=args.batch_size, 
-            shuffle=False,
-            num_workers=args.num_workers)
+    dataset_sampler = build_sampler(train_graphs, args, max_nodes=max_nodes, split='train')
+    train_dataset_loader = build_loader(dataset_sampler, args, shuffle=True)
+
+    dataset_sampler = build_sampler(val_graphs, args, max_nodes=max_nodes, split='val')
+    val_dataset_loader = build_loader(dataset_sampler, args, shuffle=False,
+            batch_size=args.eval_batch_size)
+
+    dataset_sampler = build_sampler(test_graphs, args, max_nodes=max_nodes, split='test')
+    test_dataset_loader = build_loader(dataset_sampler, args, shuffle=False,
+            batch_size=args.eval_batch_size)
 
     return train_dataset_loader, val_dataset_loader, test_dataset_loader, \
             dataset_sampler.max_num_nodes, dataset_sampler.feat_dim, dataset_sampler.assign_feat_dim
@@ -353,15 +403,15 @@ def syn_community1v2(args, writer=None, export_graphs=False):
                 max_num_nodes, 
                 input_dim, args.hidden_dim, args.output_dim, args.num_classes, args.num_gc_layers,
                 args.hidden_dim, assign_ratio=args.assign_ratio, num_pooling=args.num_pool,
-                bn=args.bn, linkpred=args.linkpred, assign_input_dim=assign_input_dim).cuda()
+                bn=args.bn, linkpred=args.linkpred, assign_input_dim=assign_input_dim).to(args.device)
     elif args.method == 'base-set2set':
         print('Method: base-set2set')
         model = encoders.GcnSet2SetEncoder(input_dim, args.hidden_dim, args.output_dim, 2,
-                args.num_gc_layers, bn=args.bn).cuda()
+                args.num_gc_layers, bn=args.bn).to(args.device)
     else:
         print('Method: base')
         model = encoders.GcnEncoderGraph(input_dim, args.hidden_dim, args.output_dim, 2,
-                args.num_gc_layers, bn=args.bn).cuda()
+                args.num_gc_layers, bn=args.bn).to(args.device)
 
     train(train_dataset, model, args, val_dataset=val_dataset, test_dataset=test_dataset,
             writer=writer)
@@ -391,31 +441,37 @@ def syn_community2hier(args, writer=None):
                 max_num_nodes, 
                 input_dim, args.hidden_dim, args.output_dim, args.num_classes, args.num_gc_layers,
                 args.hidden_dim, assign_ratio=args.assign_ratio, num_pooling=args.num_pool,
-                bn=args.bn, linkpred=args.linkpred, args=args, assign_input_dim=assign_input_dim).cuda()
+                bn=args.bn, linkpred=args.linkpred, args=args, assign_input_dim=assign_input_dim).to(args.device)
     elif args.method == 'base-set2set':
         print('Method: base-set2set')
         model = encoders.GcnSet2SetEncoder(input_dim, args.hidden_dim, args.output_dim, 2,
-                args.num_gc_layers, bn=args.bn, args=args, assign_input_dim=assign_input_dim).cuda()
+                args.num_gc_layers, bn=args.bn, args=args, assign_input_dim=assign_input_dim).to(args.device)
     else:
         print('Method: base')
         model = encoders.GcnEncoderGraph(input_dim, args.hidden_dim, args.output_dim, 2,
-                args.num_gc_layers, bn=args.bn, args=args).cuda()
+                args.num_gc_layers, bn=args.bn, args=args).to(args.device)
     train(train_dataset, model, args, val_dataset=val_dataset, test_dataset=test_dataset,
             writer=writer)
 
 
 def pkl_task(args, feat=None):
-    with open(os.path.join(args.datadir, args.pkl_fname), 'rb') as pkl_file:
-        data = pickle.load(pkl_file)
-    graphs = data[0]
-    labels = data[1]
-    test_graphs = data[2]
-    test_labels = data[3]
-
-    for i in range(len(graphs)):
-        graphs[i].graph['label'] = labels[i]
-    for i in range(len(test_graphs)):
-        test_graphs[i].graph['label'] = test_labels[i]
+    if args.cache:
+        data, test_data = load_data.load_pkl_cached(os.path.join(args.datadir, args.pkl_fname),
+                cache_dir=args.cache_dir)
+        graphs = load_data.to_networkx(data)
+        test_graphs = load_data.to_networkx(test_data)
+    else:
+        with open(os.path.join(args.datadir, args.pkl_fname), 'rb') as pkl_file:
+            data = pickle.load(pkl_file)
+        graphs = data[0]
+        labels = data[1]
+        test_graphs = data[2]
+        test_labels = data[3]
+
+        for i in range(len(graphs)):
+            graphs[i].graph['label'] = labels[i]
+        for i in range(len(test_graphs)):
+            test_graphs[i].graph['label'] = test_labels[i]
 
     if feat is None:
         featgen_const = featgen.ConstFeatureGen(np.ones(args.input_dim, dtype=float))
@@ -427,16 +483,26 @@ def pkl_task(args, feat=None):
     train_dataset, test_dataset, max_num_nodes = prepare_data(graphs, args, test_graphs=test_graphs)
     model = encoders.GcnEncoderGraph(
             args.input_dim, args.hidden_dim, args.output_dim, args.num_classes, 
-            args.num_gc_layers, bn=args.bn).cuda()
+            args.num_gc_layers, bn=args.bn).to(args.device)
     train(train_dataset, model, args, test_dataset=test_dataset)
     evaluate(test_dataset, model, args, 'Validation')
 
+def read_benchmark(args):
+    if args.cache:
+        return load_data.load_graphfile_cached(args.datadir, args.bmname, max_nodes=args.max_nodes,
+                cache_dir=args.cache_dir)
+    return load_data.read_graphfile_arrays(args.datadir, args.bmname, max_nodes=args.max_nodes)
+
 def benchmark_task(args, writer=None, feat='node-label'):
-    graphs = load_data.read_graphfile(args.datadir, args.bmname, max_nodes=args.max_nodes)
+    data = read_benchmark(args)
+    graphs = load_data.to_networkx(data)
     
     if feat == 'node-feat' and 'feat_dim' in graphs[0].graph:
         print('Using node features')
         input_dim = graphs[0].graph['feat_dim']
+    elif feat == 'node-label' and args.feature_type == 'label':
+        # the sampler reads the label indices off the 'label' node attributes
+        print('Using node label indices')
     elif feat == 'node-label' and 'label' in graphs[0].node[0]:
         print('Using node labels')
         for G in graphs:
@@ -447,6 +513,7 @@ def benchmark_task(args, writer=None, feat='node-label'):
         featgen_const = featgen.ConstFeatureGen(np.ones(args.input_dim, dtype=float))
         for G in graphs:
             featgen_const.gen_node_features(G)
+    add_dataset_features(graphs, data, args)
 
     train_dataset, val_dataset, test_dataset, max_num_nodes, input_dim, assign_input_dim = \
             prepare_data(graphs, args, max_nodes=args.max_nodes)
@@ -457,17 +524,17 @@ def benchmark_task(args, writer=None, feat='node-label'):
                 input_dim, args.hidden_dim, args.output_dim, args.num_classes, args.num_gc_layers,
                 args.hidden_dim, assign_ratio=args.assign_ratio, num_pooling=args.num_pool,
                 bn=args.bn, dropout=args.dropout, linkpred=args.linkpred, args=args,
-                assign_input_dim=assign_input_dim).cuda()
+                assign_input_dim=assign_input_dim).to(args.device)
     elif args.method == 'base-set2set':
         print('Method: base-set2set')
         model = encoders.GcnSet2SetEncoder(
                 input_dim, args.hidden_dim, args.output_dim, args.num_classes,
-                args.num_gc_layers, bn=args.bn, dropout=args.dropout, args=args).cuda()
+                args.num_gc_layers, bn=args.bn, dropout=args.dropout, args=args).to(args.device)
     else:
         print('Method: base')
         model = encoders.GcnEncoderGraph(
                 input_dim, args.hidden_dim, args.output_dim, args.num_classes, 
-                args.num_gc_layers, bn=args.bn, dropout=args.dropout, args=args).cuda()
+                args.num_gc_layers, bn=args.bn, dropout=args.dropout, args=args).to(args.device)
 
     train(train_dataset, model, args, val_dataset=val_dataset, test_dataset=test_dataset,
             writer=writer)
@@ -476,13 +543,17 @@ def benchmark_task(args, writer=None, feat='node-label'):
 
 def benchmark_task_val(args, writer=None, feat='node-label'):
     all_vals = []
-    graphs = load_data.read_graphfile(args.datadir, args.bmname, max_nodes=args.max_nodes)
+    data = read_benchmark(args)
+    graphs = load_data.to_networkx(data)
 
     example_node = util.node_dict(graphs[0])[0]
     
     if feat == 'node-feat' and 'feat_dim' in graphs[0].graph:
         print('Using node features')
         input_dim = graphs[0].graph['feat_dim']
+    elif feat == 'node-label' and args.feature_type == 'label':
+        # the sampler reads the label indices off the 'label' node attributes
+        print('Using node label indices')
     elif feat == 'node-label' and 'label' in example_node:
         print('Using node labels')
         for G in graphs:
@@ -493,10 +564,18 @@ def benchmark_task_val(args, writer=None, feat='node-label'):
         featgen_const = featgen.ConstFeatureGen(np.ones(args.input_dim, dtype=float))
         for G in graphs:
             featgen_const.gen_node_features(G)
+    add_dataset_features(graphs, data, args)
+
+    # one preprocessed copy of the dataset, shared by all folds (and DataLoader workers)
+    dataset = None
+    if args.share_dataset:
+        dataset = build_sampler(graphs, args, max_nodes=args.max_nodes, split='all')
+        dataset.share_memory()
 
     for i in range(10):
         train_dataset, val_dataset, max_num_nodes, input_dim, assign_input_dim = \
-                cross_val.prepare_val_data(graphs, args, i, max_nodes=args.max_nodes)
+                cross_val.prepare_val_data(graphs, args, i, max_nodes=args.max_nodes,
+                        dataset=dataset)
         if args.method == 'soft-assign':
             print('Method: soft-assign')
             model = encoders.SoftPoolingGcnEncoder(
@@ -504,29 +583,38 @@ def benchmark_task_val(args, writer=None, feat='node-label'):
                     input_dim, args.hidden_dim, args.output_dim, args.num_classes, args.num_gc_layers,
                     args.hidden_dim, assign_ratio=args.assign_ratio, num_pooling=args.num_pool,
                     bn=args.bn, dropout=args.dropout, linkpred=args.linkpred, args=args,
-                    assign_input_dim=assign_input_dim).cuda()
+                    assign_input_dim=assign_input_dim).to(args.device)
         elif args.method == 'base-set2set':
             print('Method: base-set2set')
             model = encoders.GcnSet2SetEncoder(
                     input_dim, args.hidden_dim, args.output_dim, args.num_classes,
-                    args.num_gc_layers, bn=args.bn, dropout=args.dropout, args=args).cuda()
+                    args.num_gc_layers, bn=args.bn, dropout=args.dropout, args=args).to(args.device)
         else:
             print('Method: base')
             model = encoders.GcnEncoderGraph(
                     input_dim, args.hidden_dim, args.output_dim, args.num_classes, 
-                    args.num_gc_layers, bn=args.bn, dropout=args.dropout, args=args).cuda()
-
-        _, val_accs = train(train_dataset, model, args, val_dataset=val_dataset, test_dataset=None,
-            writer=writer)
-        all_vals.append(np.array(val_accs))
-    all_vals = np.vstack(all_vals)
-    all_vals = np.mean(all_vals, axis=0)
+                    args.num_gc_layers, bn=args.bn, dropout=args.dropout, args=args).to(args.device)
+
+        _, val_accs, val_epochs = train(train_dataset, model, args, val_dataset=val_dataset,
+            test_dataset=None, writer=writer)
+        all_vals.append(dict(zip(val_epochs, val_accs)))
+    # mean over the folds of the validation accuracy of each evaluated epoch. The folds may be
+    # evaluated at different epochs (--eval-time) or stop early (--patience): each fold keeps
+    # its last accuracy until its next evaluation, or after it stopped
+    epochs = sorted(set().union(*all_vals))
+    fold_vals = np.full((len(all_vals), len(epochs)), np.nan)
+    for i, vals in enumerate(all_vals):
+        acc = np.nan
+        for j, epoch in enumerate(epochs):
+            acc = vals.get(epoch, acc)
+            fold_vals[i, j] = acc
+    all_vals = np.nanmean(fold_vals, axis=0)
     print(all_vals)
     print(np.max(all_vals))
-    print(np.argmax(all_vals))
+    print(epochs[np.argmax(all_vals)])
     
     
-def arg_parse():
+def build_arg_parser():
     parser = argparse.ArgumentParser(description='GraphPool arguments.')
     io_parser = parser.add_mutually_exclusive_group(required=False)
     io_parser.add_argument('--dataset', dest='dataset', 
@@ -545,14 +633,51 @@ def arg_parse():
     parser.add_argument('--linkpred', dest='linkpred', action='store_const',
             const=True, default=False,
             help='Whether link prediction side objective is used')
+    parser.add_argument('--fuse-assign', dest='fuse_assign', action='store_const',
+            const=True, default=False,
+            help='Whether the embedding and assignment GNNs of each pooling level share their '
+                 'adjacency products (soft-assign).')
+    parser.add_argument('--checkpoint', dest='checkpoint',
+            help='Activation checkpointing, recomputing activations in the backward pass to save '
+                 'memory. Can be: block (each conv layer), level (each stack of conv layers, '
+                 'i.e. each GNN of a pooling level)')
+    parser.add_argument('--linkpred-mode', dest='linkpred_mode',
+            help='Computation of the link prediction loss. Can be: dense, chunked (same loss, '
+                 'by blocks of rows), sampled (all edges and sampled node pairs)')
+    parser.add_argument('--linkpred-chunk', dest='linkpred_chunk', type=int,
+            help='Number of rows per block of the chunked link prediction loss.')
+    parser.add_argument('--linkpred-neg-ratio', dest='linkpred_neg_ratio', type=float,
+            help='Number of node pairs sampled per edge by the sampled link prediction loss.')
 
 
     parser.add_argument('--datadir', dest='datadir',
             help='Directory where benchmark is located')
+    parser.add_argument('--cache-dir', dest='cache_dir',
+            help='Directory of converted binary datasets. Default to <datadir>/cache')
+    parser.add_argument('--nocache', dest='cache', action='store_const',
+            const=False, default=True,
+            help='Whether to disable the binary dataset cache and parse the source files.')
     parser.add_argument('--logdir', dest='logdir',
             help='Tensorboard log directory')
     parser.add_argument('--cuda', dest='cuda',
             help='CUDA.')
+    parser.add_argument('--device', dest='device',
+            help='Device to train on, e.g. cpu, cuda or cuda:1. Default to cuda if available.')
+    parser.add_argument('--num-threads', dest='num_threads', type=int,
+            help='Number of intra-op threads of torch. Default to the number of cores of '
+                 '--cpu-affinity if given, else to the torch default.')
+    parser.add_argument('--num-interop-threads', dest='num_interop_threads', type=int,
+            help='Number of inter-op threads of torch.')
+    parser.add_argument('--cpu-affinity', dest='cpu_affinity',
+            help='Cores the process (and its DataLoader workers) may run on, e.g. 0-7,16-23.')
+    parser.add_argument('--bf16', dest='bf16', action='store_const',
+            const=True, default=False,
+            help='Whether to run the forward pass under bfloat16 autocast (matmuls and pooling '
+                 'products in bfloat16; softmaxes, link prediction logs and loss in float32).')
+    parser.add_argument('--compile', dest='compile', action='store_const',
+            const=True, default=False,
+            help='Whether to compile the forward pass of the encoder with torch.compile (not with '
+                 'sparse adjacency matrices or --checkpoint).')
     parser.add_argument('--max-nodes', dest='max_nodes', type=int,
             help='Maximum number of nodes (ignore graghs with nodes exceeding the number.')
     parser.add_argument('--lr', dest='lr', type=float,
@@ -561,14 +686,56 @@ def arg_parse():
             help='Gradient clipping.')
     parser.add_argument('--batch-size', dest='batch_size', type=int,
             help='Batch size.')
+    parser.add_argument('--bucket', dest='bucket', action='store_const',
+            const=True, default=False,
+            help='Whether to batch graphs of similar sizes and pad each batch to its largest graph.')
+    parser.add_argument('--batch-cost', dest='batch_cost', type=int,
+            help='With --bucket, form variable-size batches with batch size * (padded nodes)^2 '
+                 'at most this cost instead of fixed-size batches.')
+    parser.add_argument('--packed', dest='packed', action='store_const',
+            const=True, default=False,
+            help='Whether to concatenate the graphs of a batch into a block-diagonal sparse '
+                 'graph instead of padding them. Only for --method=base and base-set2set.')
+    parser.add_argument('--sparse-adj', dest='sparse_adj', action='store_const',
+            const=True, default=False,
+            help='Whether to feed the adjacency matrices of padded batches to the encoders as '
+                 'sparse tensors.')
     parser.add_argument('--epochs', dest='num_epochs', type=int,
             help='Number of epochs to train.')
+    parser.add_argument('--eval-batch-size', dest='eval_batch_size', type=int,
+            help='Batch size of the validation and test sets. Default to --batch-size.')
+    parser.add_argument('--eval-every', dest='eval_every', type=int,
+            help='Number of epochs between evaluations (the last epoch is always evaluated).')
+    parser.add_argument('--eval-time', dest='eval_time', type=float,
+            help='If given, evaluate after the first epoch that ends at least this many seconds '
+                 'after the previous evaluation, instead of every --eval-every epochs.')
+    parser.add_argument('--patience', dest='patience', type=int,
+            help='Stop training when the validation accuracy has not improved for this many '
+                 'epochs. Default to never stopping early.')
     parser.add_argument('--train-ratio', dest='train_ratio', type=float,
             help='Ratio of number of graphs training set to all graphs.')
     parser.add_argument('--num_workers', dest='num_workers', type=int,
             help='Number of workers to load data.')
+    parser.add_argument('--prefetch', dest='prefetch', type=int,
+            help='Number of batches prepared (collated, converted and copied to the device) '
+                 'ahead of the model by a background thread. 0 to prepare them in the training '
+                 'loop.')
+    parser.add_argument('--sampler-workers', dest='sampler_workers', type=int,
+            help='Number of workers featurizing graphs when building the datasets.')
+    parser.add_argument('--sampler-pool', dest='sampler_pool',
+            help='Worker pool used to build the datasets. Can be: process, thread')
+    parser.add_argument('--storage-dir', dest='storage_dir',
+            help='Directory of memory-mapped dataset arrays. Default to keeping them in memory.')
+    parser.add_argument('--noshare', dest='share_dataset', action='store_const',
+            const=False, default=True,
+            help='Whether to build a separate dataset for each cross validation fold.')
+    parser.add_argument('--feat-dtype', dest='feat_dtype',
+            help='Storage dtype of the dataset features. Can be: float32, float16')
+    parser.add_argument('--adj-storage', dest='adj_storage',
+            help='Storage of the dataset adjacency matrices. Can be: dense, packbits, edgelist')
     parser.add_argument('--feature', dest='feature_type',
-            help='Feature used for encoder. Can be: id, deg')
+            help='Feature used for encoder. Can be: id, deg, deg-num, struct, label (node label '
+                 'indices instead of one-hot node labels)')
     parser.add_argument('--input-dim', dest='input_dim', type=int,
             help='Input feature dimension')
     parser.add_argument('--hidden-dim', dest='hidden_dim', type=int,
@@ -593,6 +760,9 @@ def arg_parse():
 
     parser.add_argument('--method', dest='method',
             help='Method. Possible values: base, base-set2set, soft-assign')
+    parser.add_argument('--s2s-steps', dest='s2s_steps', type=int,
+            help='Number of Set2Set processing steps (base-set2set). 0 for one step per node '
+                 'slot of the padded batch.')
     parser.add_argument('--name-suffix', dest='name_suffix',
             help='suffix added to the output filename')
 
@@ -602,6 +772,8 @@ def arg_parse():
                         max_nodes=1000,
                         cuda='1',
                         feature_type='default',
+                        feat_dtype='float32',
+                        adj_storage='dense',
                         lr=0.001,
                         clip=2.0,
                         batch_size=20,
@@ -609,6 +781,10 @@ def arg_parse():
                         train_ratio=0.8,
                         test_ratio=0.1,
                         num_workers=1,
+                        prefetch=2,
+                        eval_every=1,
+                        sampler_workers=1,
+                        sampler_pool='process',
                         input_dim=10,
                         hidden_dim=20,
                         output_dim=20,
@@ -617,13 +793,82 @@ def arg_parse():
                         dropout=0.0,
                         method='base',
                         name_suffix='',
+                        s2s_steps=3,
+                        linkpred_mode='chunked',
+                        linkpred_chunk=128,
+                        linkpred_neg_ratio=1.0,
+                        checkpoint=None,
                         assign_ratio=0.1,
                         num_pool=1
                        )
-    return parser.parse_args()
+    return parser
+
+def parse_cpu_list(cpus):
+    ''' Set of cores of a list of cores and ranges of cores such as '0-7,16-23'.
+    '''
+    cores = set()
+    for part in cpus.split(','):
+        lo, _, hi = part.partition('-')
+        cores.update(range(int(lo), int(hi or lo) + 1))
+    return cores
+
+def setup_device(args):
+    ''' Apply --cpu-affinity and the torch thread counts, and resolve args.device (a
+    torch.device afterwards). Call before any torch computation: the number of inter-op
+    threads cannot be changed once they started.
+    '''
+    if args.cpu_affinity is not None:
+        os.sched_setaffinity(0, parse_cpu_list(args.cpu_affinity))
+    if args.num_threads is not None:
+        torch.set_num_threads(args.num_threads)
+    elif args.cpu_affinity is not None:
+        torch.set_num_threads(len(os.sched_getaffinity(0)))
+    if args.num_interop_threads is not None:
+        torch.set_num_interop_threads(args.num_interop_threads)
+    if args.device is None:
+        args.device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    args.device = torch.device(args.device)
+    print('Device: ', args.device, '; intra-op threads: ', torch.get_num_threads(),
+          '; inter-op threads: ', torch.get_num_interop_threads())
+
+def autocast(args):
+    ''' Autocast context of the forward pass: bfloat16 on args.device with --bf16, else a
+    no-op.
+    '''
+    return torch.autocast(device_type=args.device.type, dtype=torch.bfloat16,
+                          enabled=args.bf16)
+
+def compile_model(model, args):
+    ''' With --compile, compile the forward pass of model with torch.compile, in place (the
+    model keeps its attributes and parameter names). Bucketed batches (--bucket) vary in
+    size, so their shapes are compiled as dynamic from the start instead of after the first
+    recompilation. Sparse adjacency matrices (--sparse-adj, --packed) cannot be captured: each
+    sparse product would split the forward pass into one graph per layer, slower than eager
+    execution, so those models stay eager, as do checkpointed ones (--checkpoint, whose
+    recomputation freezes the batch norm statistics in a way torch.compile cannot trace).
+    Functions the compiler fails on, or that recompile too often, fall back to eager execution,
+    with a warning from torch._dynamo; this only applies to the forward pass of model.
+    '''
+    if not args.compile:
+        return model
+    if args.sparse_adj or args.packed:
+        print('Sparse adjacency matrices: not compiling the model')
+        return model
+    if args.checkpoint is not None:
+        print('Activation checkpointing: not compiling the model')
+        return model
+    forward = torch.compile(model.forward, dynamic=True if args.bucket else None)
+    model.forward = torch._dynamo.config.patch(suppress_errors=True)(forward)
+    print('Compiling the model; functions that fail to compile run eagerly')
+    return model
+
+def arg_parse():
+    return build_arg_parser().parse_args()
 
 def main():
     prog_args = arg_parse()
+    if prog_args.packed and prog_args.method not in ['base', 'base-set2set']:
+        raise ValueError('Packed batches are only supported by methods base and base-set2set')
 
     # export scalar data to JSON for external processing
     path = os.path.join(prog_args.logdir, gen_prefix(prog_args))
@@ -635,6 +880,7 @@ def main():
 
     os.environ['CUDA_VISIBLE_DEVICES'] = prog_args.cuda
     print('CUDA', prog_args.cuda)
+    setup_device(prog_args)
 
     if prog_args.bmname is not None:
         benchmark_task_val(prog_args, writer=writer)